@@ -0,0 +1,266 @@
+"""Local stand-in for the pyncm endpoints, the audio CDN and VLC
+
+install() registers fake pyncm and vlc modules before the client is imported,
+so that it runs headless, without network access, audio output or either
+package installed. The API answers from a synthetic catalogue after a fixed
+latency. The CDN is an aiohttp server on its own thread serving synthetic
+audio with Range support, and GetTrackAudioV1 points every track at it.
+"""
+
+from __future__ import annotations
+import re
+import sys
+import time
+import types
+import asyncio
+import hashlib
+import requests
+from collections import Counter
+from threading import Thread
+from aiohttp import web
+
+CDN_PORT = 5903
+# Tracks returned with the playlist itself, the rest are listed by id
+FIRST = 1000
+# Results available for any search query
+SEARCH_RESULTS = 500
+# Id of the liked playlist, listed first like the real one
+LIKED = 1
+
+
+class Catalogue:
+    """Synthetic account with playlists of the given sizes"""
+
+    def __init__(self, sizes: list[int], latency: float = 0.05, audio_size: int = 2 ** 20):
+        # Playlist ids start after the liked one
+        self.playlists = {LIKED: 200, **{i + 2: size for i, size in enumerate(sizes)}}
+        self.latency = latency
+        self.audio = bytes(audio_size)
+        self.md5 = hashlib.md5(self.audio).hexdigest()
+        self.calls: Counter[str] = Counter()
+
+    def wait(self, name: str) -> None:
+        self.calls[name] += 1
+        time.sleep(self.latency)
+
+    @staticmethod
+    def playlist_tracks(playlist_id: int, size: int) -> list[int]:
+        return [playlist_id * 1_000_000 + i for i in range(size)]
+
+    @staticmethod
+    def song(track_id: int) -> dict:
+        return {'name': f'Track {track_id}', 'id': track_id, 'dt': 240_000,
+                'ar': [{'id': track_id % 500, 'name': f'Artist {track_id % 500}'}],
+                'al': {'id': track_id % 2000, 'name': f'Album {track_id % 2000}'}}
+
+    def url(self, track_id: int) -> str:
+        return f'http://127.0.0.1:{CDN_PORT}/{track_id}.mp3'
+
+    # pyncm.apis.user
+
+    def GetUserPlaylists(self, *_, **__):
+        self.wait('GetUserPlaylists')
+        return {'playlist': [{'name': f'Playlist {size}', 'id': pid, 'trackCount': size}
+                             for pid, size in self.playlists.items()]}
+
+    def GetUserArtistSubs(self, limit=9, offset=0):
+        self.wait('GetUserArtistSubs')
+        return {'hasMore': offset + limit < 50,
+                'data': [{'name': f'Artist {i}', 'id': i} for i in range(offset, offset + limit)]}
+
+    def GetUserAlbumSubs(self, limit=9, offset=0):
+        self.wait('GetUserAlbumSubs')
+        return {'hasMore': offset + limit < 50,
+                'data': [{'name': f'Album {i}', 'id': i} for i in range(offset, offset + limit)]}
+
+    def GetArtistTopSongs(self, artist_id):
+        self.wait('GetArtistTopSongs')
+        return {'songs': [self.song(int(artist_id) * 1000 + i) for i in range(50)]}
+
+    def GetDailyRecommends(self):
+        self.wait('GetDailyRecommends')
+        return {'data': {'dailySongs': [self.song(i) for i in range(30)]}}
+
+    # pyncm.apis.album, pyncm.apis.playlist
+
+    def GetAlbumInfo(self, album_id):
+        self.wait('GetAlbumInfo')
+        return {'songs': [self.song(int(album_id) * 100 + i) for i in range(12)]}
+
+    def GetPlaylistInfo(self, playlist_id):
+        self.wait('GetPlaylistInfo')
+        playlist_id = int(playlist_id)
+        ids = self.playlist_tracks(playlist_id, self.playlists.get(playlist_id, 0))
+        return {'playlist': {'tracks': [self.song(i) for i in ids[:FIRST]],
+                             'trackIds': [{'id': i} for i in ids]}}
+
+    # pyncm.apis.track
+
+    def GetTrackDetail(self, track_ids):
+        self.wait('GetTrackDetail')
+        return {'songs': [self.song(int(i)) for i in track_ids]}
+
+    def GetTrackAudioV1(self, track_ids, level='exhigh', **_):
+        self.wait('GetTrackAudioV1')
+        return {'data': [{'id': int(i), 'url': self.url(i), 'size': len(self.audio),
+                          'md5': self.md5, 'level': level, 'expi': 1200} for i in track_ids]}
+
+    def GetTrackLyrics(self, track_id, **_):
+        self.wait('GetTrackLyrics')
+        lines = (f'[{second // 60:02}:{second % 60:02}.00]Line {second // 5}' for second in range(0, 240, 5))
+        return {'lrc': {'lyric': '\n'.join(lines)}}
+
+    def SetLikeTrack(self, track_id, like=True, **_):
+        self.wait('SetLikeTrack')
+        return {'code': 200}
+
+    # pyncm.apis.cloudsearch
+
+    def GetSearchResult(self, keyword, stype=1, limit=30, offset=0):
+        self.wait('GetSearchResult')
+        seed = sum(map(ord, keyword)) * 10_000
+        ids = range(seed + offset, seed + min(offset + limit, SEARCH_RESULTS))
+        if stype == 1:
+            return {'result': {'songs': [self.song(i) for i in ids]}}
+        if stype == 10:
+            return {'result': {'albums': [{'name': f'Album {i}', 'id': i, 'size': 12,
+                                           'publishTime': 1_600_000_000_000,
+                                           'artist': {'name': f'Artist {i}', 'id': i}}
+                                          for i in ids]}}
+        if stype == 100:
+            return {'result': {'artists': [{'name': f'Artist {i}', 'id': i} for i in ids]}}
+        return {'result': {'playlists': [{'name': f'Playlist {i}', 'id': i, 'trackCount': 10,
+                                          'creator': {'nickname': 'Curator'}} for i in ids]}}
+
+    # Requests defined in the client with WeapiCryptoRequest
+
+    def weapi(self, path: str, params: dict):
+        self.wait(path)
+        if path == '/weapi/song/like/get':
+            return {'code': 200, 'ids': self.playlist_tracks(LIKED, self.playlists[LIKED])}
+        return {'code': 200}
+
+
+class Session(requests.Session):
+    uid = 1
+
+
+def install(catalogue: Catalogue) -> None:
+    """Register the fake pyncm and vlc modules, before importing the client"""
+    pyncm = types.ModuleType('pyncm')
+    apis = types.ModuleType('pyncm.apis')
+    session = Session()
+    pyncm.apis = apis
+    pyncm.GetCurrentSession = lambda: session
+    pyncm.SetCurrentSession = lambda _: None
+    pyncm.LoadSessionFromString = lambda _: session
+    pyncm.DumpSessionAsString = lambda _: ''
+
+    def weapi(fn):
+        def request(*args, **kwargs):
+            return catalogue.weapi(*fn(*args, **kwargs))
+        return request
+    apis.WeapiCryptoRequest = weapi
+
+    endpoints = {
+        'user': ['GetUserPlaylists', 'GetUserArtistSubs', 'GetUserAlbumSubs',
+                 'GetArtistTopSongs', 'GetDailyRecommends'],
+        'album': ['GetAlbumInfo'],
+        'playlist': ['GetPlaylistInfo'],
+        'track': ['GetTrackDetail', 'GetTrackAudioV1', 'GetTrackLyrics', 'SetLikeTrack'],
+        'cloudsearch': ['GetSearchResult'],
+        'login': [],
+    }
+    for name, functions in endpoints.items():
+        module = types.ModuleType(f'pyncm.apis.{name}')
+        for function in functions:
+            setattr(module, function, getattr(catalogue, function))
+        setattr(apis, name, module)
+        sys.modules[module.__name__] = module
+    apis.login.LoginFailedException = type('LoginFailedException', (Exception,), {})
+    sys.modules['pyncm'] = pyncm
+    sys.modules['pyncm.apis'] = apis
+    sys.modules['vlc'] = fake_vlc()
+
+
+def fake_vlc() -> types.ModuleType:
+    """A media player that plays nothing and reports no progress"""
+    vlc = types.ModuleType('vlc')
+
+    class EventType:
+        MediaPlayerEndReached = 'end'
+        MediaPlayerPlaying = 'playing'
+        MediaPlayerTimeChanged = 'time'
+        MediaPlayerPaused = 'paused'
+        MediaPlayerStopped = 'stopped'
+
+    class EventManager:
+        def event_attach(self, *_):
+            pass
+
+    class Media:
+        def __init__(self, mrl):
+            self.mrl = mrl
+
+    class MediaPlayer:
+        def __init__(self, *_):
+            self.playing = False
+            self.manager = EventManager()
+
+        def event_manager(self):
+            return self.manager
+
+        def set_media(self, media):
+            pass
+
+        def play(self):
+            self.playing = True
+
+        def pause(self):
+            self.playing = False
+
+        def stop(self):
+            self.playing = False
+
+        def is_playing(self):
+            return self.playing
+
+        def will_play(self):
+            return True
+
+        def get_time(self):
+            return 0
+
+        def get_length(self):
+            return 0
+
+    vlc.EventType = EventType
+    vlc.Media = Media
+    vlc.MediaPlayer = MediaPlayer
+    return vlc
+
+
+def serve_cdn(catalogue: Catalogue, port: int = CDN_PORT) -> None:
+    """Serve the catalogue audio on a daemon thread"""
+    body = catalogue.audio
+
+    async def audio(request: web.Request):
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        if not match:
+            return web.Response(body=body, content_type='audio/mpeg')
+        start, end = int(match[1]), int(match[2]) if match[2] else len(body) - 1
+        if start >= len(body):
+            return web.Response(status=416)
+        headers = {'Content-Range': f'bytes {start}-{end}/{len(body)}'}
+        return web.Response(body=body[start:end + 1], status=206, headers=headers,
+                            content_type='audio/mpeg')
+
+    async def run():
+        app = web.Application()
+        app.router.add_get(r'/{name}', audio)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        await asyncio.Event().wait()
+
+    Thread(target=asyncio.run, args=(run(),), daemon=True).start()
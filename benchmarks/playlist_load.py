@@ -0,0 +1,61 @@
+"""Time loading a large playlist against a simulated API
+
+GetPlaylistInfo returns the first 1000 tracks with the full trackIds list,
+GetTrackDetail resolves any list of ids. Both sleep for a fixed latency to
+stand in for the network round trip.
+
+Usage: python benchmarks/playlist_load.py [tracks] [latency in ms]
+"""
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.append(str(Path(__file__).parents[1].joinpath('textualncm')))
+import _menu  # noqa: E402
+
+
+def song(track_id: int) -> dict:
+    return {'name': f'Track {track_id}', 'id': track_id,
+            'ar': [{'id': 1, 'name': 'Artist'}], 'al': {'id': 1, 'name': 'Album'}}
+
+
+def fake_apis(size: int, latency: float, first: int = 1000):
+    def playlist_info(_):
+        time.sleep(latency)
+        return {'playlist': {'tracks': [song(i) for i in range(first)],
+                             'trackIds': [{'id': i} for i in range(size)]}}
+
+    def track_detail(track_ids):
+        time.sleep(latency)
+        return {'songs': [song(i) for i in track_ids]}
+
+    return SimpleNamespace(playlist=SimpleNamespace(GetPlaylistInfo=playlist_info),
+                           track=SimpleNamespace(GetTrackDetail=track_detail))
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 300) / 1000
+    _menu.apis = fake_apis(size, latency)
+
+    start = time.perf_counter()
+    first_page = None
+    loaded = 0
+    for page in _menu.iter_playlist('bench'):
+        loaded += len(page)
+        if first_page is None:
+            first_page = time.perf_counter() - start
+    total = time.perf_counter() - start
+    assert loaded == size, loaded
+
+    batches = -(-(size - 1000) // _menu.BATCH)
+    sequential = latency * (1 + batches)
+    print(f'{size} tracks, {latency * 1000:.0f} ms latency, {batches} detail batches')
+    print(f'first page:  {first_page * 1000:8.1f} ms')
+    print(f'all tracks:  {total * 1000:8.1f} ms')
+    print(f'sequential:  {sequential * 1000:8.1f} ms (estimated)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Measure time to first byte and throughput of the streaming proxy
+
+A local aiohttp server stands in for the audio CDN and serves a synthetic
+track with Range support. The proxy resolves every track to it and streams
+into a throwaway audio cache, so the second round is served from disk.
+
+Usage: python benchmarks/proxy_stream.py [track size in MiB] [concurrency ...]
+"""
+
+from __future__ import annotations
+import sys
+import time
+import asyncio
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1].joinpath('textualncm')))
+from aiohttp import web, ClientSession  # noqa: E402
+import _proxy  # noqa: E402
+from _audiocache import AudioCache  # noqa: E402
+
+UPSTREAM = 5901
+PROXY = 5902
+
+
+def upstream_app(body: bytes) -> web.Application:
+    async def audio(request: web.Request):
+        byte_range = _proxy.parse_range(request.headers.get('Range'))
+        if byte_range is None:
+            return web.Response(body=body, content_type='audio/mpeg')
+        start, end = byte_range
+        end = len(body) - 1 if end is None else end
+        headers = {'Content-Range': f'bytes {start}-{end}/{len(body)}'}
+        return web.Response(body=body[start:end + 1], status=206, headers=headers,
+                            content_type='audio/mpeg')
+
+    app = web.Application()
+    app.router.add_get(r'/{name}', audio)
+    return app
+
+
+async def fetch(session: ClientSession, track_id: int) -> tuple[float, int]:
+    start = time.perf_counter()
+    ttfb = None
+    received = 0
+    async with session.get(f'http://127.0.0.1:{PROXY}/track/{track_id}') as response:
+        async for chunk in response.content.iter_any():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+            received += len(chunk)
+    return ttfb, received
+
+
+async def round_trip(concurrency: int, first_id: int) -> tuple[float, float]:
+    async with ClientSession() as session:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(fetch(session, first_id + i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    ttfb = sum(result[0] for result in results) / len(results)
+    throughput = sum(result[1] for result in results) / elapsed / 2 ** 20
+    return ttfb, throughput
+
+
+async def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    levels = [int(arg) for arg in sys.argv[2:]] or [1, 4, 16]
+    body = bytes(size * 2 ** 20)
+
+    _proxy.audiocache = AudioCache(Path(tempfile.mkdtemp()), limit=2 ** 40)
+
+    async def resolve(track_id: int, fresh: bool = False) -> dict:
+        return {'url': f'http://127.0.0.1:{UPSTREAM}/{track_id}.mp3', 'size': len(body)}
+    _proxy.resolve = resolve
+
+    upstream = web.AppRunner(upstream_app(body), access_log=None)
+    await upstream.setup()
+    await web.TCPSite(upstream, '127.0.0.1', UPSTREAM).start()
+    proxy = asyncio.create_task(_proxy.serve(port=PROXY))
+    await asyncio.sleep(0.5)
+
+    print(f'{size} MiB tracks')
+    print(f'{"streams":>8} {"source":>8} {"ttfb":>10} {"throughput":>14}')
+    first_id = 0
+    for concurrency in levels:
+        for source in ('upstream', 'cache'):
+            ttfb, throughput = await round_trip(concurrency, first_id)
+            print(f'{concurrency:>8} {source:>8} {ttfb * 1000:>8.1f}ms {throughput:>9.1f} MiB/s')
+        first_id += concurrency
+
+    proxy.cancel()
+    await upstream.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
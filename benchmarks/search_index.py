@@ -0,0 +1,65 @@
+"""Measure indexing and query time of the local track index
+
+Usage: python benchmarks/search_index.py [count]
+"""
+import sys
+import time
+import random
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1].joinpath('textualncm')))
+from _track import Track  # noqa: E402
+import _index  # noqa: E402
+from _index import index, pinyin  # noqa: E402
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+HAN = '晴天七里香夜曲稻花海青蓝月光星雨风云山水爱心梦火'
+QUERIES = ['a', 'mo', 'night', 'nihgt', 'nught', 'nigth', 'ni moon', '七里', '夜曲', 'lov nigt', 'qilixiang']
+
+
+def word(rng: random.Random) -> str:
+    if rng.random() < 0.3:
+        return ''.join(rng.choice(HAN) for _ in range(rng.randint(2, 5)))
+    return ''.join(rng.choice(LETTERS) for _ in range(rng.randint(3, 8)))
+
+
+def title(rng: random.Random) -> str:
+    # Real titles mix a few common words with rarer ones
+    common = ['love', 'night', 'moon', '七里香', '夜曲']
+    parts = [word(rng) for _ in range(rng.randint(1, 3))]
+    if rng.random() < 0.2:
+        parts.append(rng.choice(common))
+    return ' '.join(parts)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rng = random.Random(0)
+    # Index in the foreground to time it
+    _index.WINDOW = 3600
+    artists = [title(rng) for _ in range(number // 20)]
+    albums = [title(rng) for _ in range(number // 10)]
+    tracks = []
+    for i in range(number):
+        artist = rng.randrange(len(artists))
+        album = rng.randrange(len(albums))
+        tracks.append(Track(title(rng), i, {artist: artists[artist]}, albums[album], album))
+
+    index.add(tracks)
+    start = time.perf_counter()
+    index.flush()
+    elapsed = time.perf_counter() - start
+    print(f'{len(tracks)} tracks, {len(index.postings)} grams, pinyin {"on" if pinyin() else "off"}')
+    print(f'indexing: {elapsed * 1000:8.1f} ms')
+
+    for query in QUERIES:
+        runs = 20
+        start = time.perf_counter()
+        for _ in range(runs):
+            results = index.search(query)
+        elapsed = (time.perf_counter() - start) / runs
+        print(f'{query!r:14} {elapsed * 1000:6.2f} ms  {len(index.match(query)):6} matches, {len(results)} shown')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+"""Headless benchmark suite against a local stand-in for the NCM API and CDN
+
+The client runs without a terminal, network access or VLC (see fakencm.py),
+with its caches and downloads in a temporary directory. Every result is a
+JSON record of a benchmark, a playlist size where it applies and its
+metrics, so that runs can be compared across releases.
+
+Benchmarks:
+  table_update   filling a TrackTable, then updating it after one change
+  startup        phases of a cold and a warm start, each in a new process
+  playlist_open  first and last rows of a playlist, uncached then cached
+  search         remote search uncached, cached and as typed, local index
+  proxy          time to first byte through the proxy, upstream and cached
+  downloader     Downloader throughput on a batch of tracks
+
+Usage: python benchmarks/suite.py [--sizes N ...] [--latency MS]
+                                  [--only NAME ...] [--output FILE]
+"""
+
+from __future__ import annotations
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import fakencm
+
+root = Path(__file__).parents[1]
+sys.path.append(str(root.joinpath('textualncm')))
+
+BENCHMARKS = ['table_update', 'startup', 'playlist_open', 'search', 'proxy', 'downloader']
+SIZES = [1000, 10_000, 100_000]
+QUERIES = ['track', 'artist 42', 'album 7', 'trak 1', 'artst 4']
+DOWNLOADS = 20
+TIMEOUT = 300
+
+
+def isolate(home: Path) -> None:
+    """Move every store of the client into home"""
+    from _cache import metacache
+    from _library import library
+    from _audiocache import audiocache
+    import _network
+    # The stand-in CDN answers the reachability probe
+    _network.API = ('127.0.0.1', fakencm.CDN_PORT)
+    home.joinpath('downloads').mkdir(parents=True, exist_ok=True)
+    metacache.__init__(home.joinpath('cache.db'))
+    library.__init__(home.joinpath('downloads'), home.joinpath('library.json'))
+    audiocache.__init__(home.joinpath('cache', 'audio'))
+
+
+async def until(condition, timeout: float = TIMEOUT) -> float:
+    """Seconds until condition() holds"""
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError
+        await asyncio.sleep(0.005)
+    return time.perf_counter() - start
+
+
+def ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+async def table_update(sizes: list[int], catalogue) -> list[dict]:
+    from textual.app import App
+    from _table import TrackTable
+    from _track import Track
+
+    class Bench(App):
+        def compose(self):
+            yield TrackTable()
+
+    results = []
+    for size in sizes:
+        tracks = [Track(f'Track {i}', i, {1: 'Artist'}, 'Album', 1)
+                  for i in range(10 ** 9, 10 ** 9 + size)]
+        app = Bench()
+        async with app.run_test():
+            table = app.query_one(TrackTable)
+            table.tracks = list(tracks)
+            start = time.perf_counter()
+            table.update()
+            table.on_idle()
+            fill = time.perf_counter() - start
+
+            table.tracks.insert(0, Track('Liked', 10 ** 9 - 1, {1: 'Artist'}, 'Album', 1))
+            start = time.perf_counter()
+            table.update()
+            table.on_idle()
+            diff = time.perf_counter() - start
+        results.append({'benchmark': 'table_update', 'size': size,
+                        'fill_ms': ms(fill), 'diff_ms': ms(diff)})
+    return results
+
+
+def startup(latency: float) -> list[dict]:
+    home = tempfile.mkdtemp(prefix='ncm-bench-')
+    results = []
+    for run in ('cold', 'warm'):
+        output = subprocess.run(
+            [sys.executable, __file__, '--child', '--home', home, '--latency', str(latency * 1000)],
+            capture_output=True, text=True, timeout=TIMEOUT, check=True).stdout
+        phases = json.loads(output.strip().splitlines()[-1])
+        results.append({'benchmark': 'startup', 'size': None, 'run': run, **phases})
+    return results
+
+
+async def child(home: Path, latency: float) -> None:
+    """Start the app once with --profile-startup and print its phases"""
+    catalogue = fakencm.Catalogue(SIZES, latency)
+    fakencm.install(catalogue)
+    fakencm.serve_cdn(catalogue)
+    import _startup
+    isolate(home)
+    import app
+
+    application = app.NeteaseCloudMusic()
+    application.profile = True
+    _startup.mark('imports')
+    async with application.run_test(size=(120, 40)):
+        await until(lambda: not application.is_running)
+    phases = {f'{phase.replace(" ", "_")}_ms': ms(at - _startup.start) for phase, at in _startup.phases}
+    print(json.dumps(phases))
+
+
+async def with_app(sizes: list[int], catalogue, names: list[str]) -> list[dict]:
+    """Benchmarks needing the whole app, run in one session"""
+    import app
+    from _menu import PlaylistMenu, MenuTree
+    from _table import Tables, TrackTable
+    from _search import Search, SONG
+
+    results = []
+    application = app.NeteaseCloudMusic()
+    async with application.run_test(size=(120, 40)) as pilot:
+        tree = application.query_one(MenuTree)
+        await until(lambda: len(tree.root.children[3].children) > 0)
+        tables = application.query_one(Tables)
+        table = application.query_one(TrackTable)
+
+        if 'playlist_open' in names or 'search' in names:
+            for size, playlist_id in zip(sizes, list(catalogue.playlists)[1:]):
+                record = {'benchmark': 'playlist_open', 'size': size}
+                for run in ('uncached', 'cached'):
+                    table.tracks = []
+                    table.update()
+                    start = time.perf_counter()
+                    tables.show_tracks(PlaylistMenu.stream_tracks, playlist_id)
+                    first = await until(lambda: table.row_count > 0) + start
+                    await until(lambda: table.row_count == size)
+                    record[f'{run}_first_rows_ms'] = ms(first - start)
+                    record[f'{run}_all_rows_ms'] = ms(time.perf_counter() - start)
+                if 'playlist_open' in names:
+                    results.append(record)
+
+        if 'search' in names:
+            from _index import index
+            Search.fetch.cache_clear()
+            start = time.perf_counter()
+            Search.search('love', SONG)
+            uncached = time.perf_counter() - start
+            start = time.perf_counter()
+            Search.search('love', SONG)
+            cached = time.perf_counter() - start
+
+            # From the last keystroke to the results in the table, debounce included
+            search = application.query_one(Search)
+            search.focus()
+            await pilot.press(*'moon')
+            start = time.perf_counter()
+            # The stand-in numbers the results of a query after its characters
+            first = sum(map(ord, 'moon')) * 10_000
+            await until(lambda: table.tracks and table.tracks[0].id == first)
+            typed = time.perf_counter() - start
+
+            index.flush()
+            timings = []
+            for query in QUERIES:
+                start = time.perf_counter()
+                index.search(query)
+                timings.append(time.perf_counter() - start)
+            results.append({'benchmark': 'search', 'size': len(index),
+                            'remote_uncached_ms': ms(uncached), 'remote_cached_ms': ms(cached),
+                            'as_typed_ms': ms(typed),
+                            'local_median_ms': ms(statistics.median(timings)),
+                            'local_max_ms': ms(max(timings))})
+
+        if 'proxy' in names:
+            results.append(await proxy(catalogue))
+        if 'downloader' in names:
+            results.append(await downloader(application, catalogue))
+        application.action_quit()
+    return results
+
+
+async def proxy(catalogue) -> dict:
+    from aiohttp import ClientSession
+    from _streaming import url
+
+    async def fetch(session: ClientSession, track_id: int) -> tuple[float, float]:
+        start = time.perf_counter()
+        ttfb = None
+        async with session.get(url(track_id)) as response:
+            async for _ in response.content.iter_any():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+        return ttfb, time.perf_counter() - start
+
+    record = {'benchmark': 'proxy', 'size': None, 'track_bytes': len(catalogue.audio)}
+    async with ClientSession() as session:
+        await until(lambda: port_open(), timeout=10)
+        for source in ('upstream', 'cached'):
+            results = [await fetch(session, 7_000_000 + i) for i in range(4)]
+            record[f'{source}_ttfb_ms'] = ms(statistics.mean(r[0] for r in results))
+            record[f'{source}_total_ms'] = ms(statistics.mean(r[1] for r in results))
+    return record
+
+
+def port_open() -> bool:
+    import socket
+    from _streaming import HOST, PORT
+    with socket.socket() as sock:
+        return sock.connect_ex((HOST, PORT)) == 0
+
+
+async def downloader(application, catalogue) -> dict:
+    from _track import Track
+    from _session import reuse
+    from pyncm import GetCurrentSession
+    tracks = [Track(f'Download {i}', 8_000_000 + i, {1: 'Artist'}, 'Album', 1)
+              for i in range(DOWNLOADS)]
+    start = time.perf_counter()
+    application.downloader.submit_many(tracks)
+    await until(lambda: not any(track.downloading for track in tracks))
+    elapsed = time.perf_counter() - start
+    done = sum(track.local for track in tracks)
+    opened, requests = reuse(GetCurrentSession())['cdn']
+    return {'benchmark': 'downloader', 'size': DOWNLOADS, 'completed': done,
+            'elapsed_ms': ms(elapsed),
+            'throughput_mib_s': round(done * len(catalogue.audio) / elapsed / 2 ** 20, 2),
+            **{key: value for key, value in application.downloader.stats().items()
+               if key in ('limit', 'failed')},
+            'connections': opened, 'requests': requests}
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--latency', type=float, default=50, help='API latency in ms')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--output', type=Path, help='write the JSON here instead of stdout')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--home', type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    latency = args.latency / 1000
+
+    if args.child:
+        asyncio.run(child(args.home, latency))
+        return
+
+    catalogue = fakencm.Catalogue(args.sizes, latency)
+    fakencm.install(catalogue)
+    fakencm.serve_cdn(catalogue)
+    isolate(Path(tempfile.mkdtemp(prefix='ncm-bench-')))
+
+    results = []
+    if 'startup' in args.only:
+        results.extend(startup(latency))
+    if 'table_update' in args.only:
+        results.extend(asyncio.run(table_update(args.sizes, catalogue)))
+    app_benchmarks = [name for name in args.only if name not in ('startup', 'table_update')]
+    if app_benchmarks:
+        results.extend(asyncio.run(with_app(args.sizes, catalogue, app_benchmarks)))
+
+    report = {
+        'meta': {'commit': commit(),
+                 'date': datetime.now().isoformat(timespec='seconds'),
+                 'python': platform.python_version(),
+                 'platform': platform.platform(),
+                 'latency_ms': args.latency,
+                 'sizes': args.sizes,
+                 'api_calls': dict(catalogue.calls)},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Compare the cost of TrackTable updates against table size
+
+For each size the table is filled once, then a single track is liked in the
+liked view, the situation which used to rebuild the whole table. 'rebuild'
+times clear() plus add_row() for every track, 'diff' times TrackTable.update.
+Both include the dimension pass the DataTable runs on idle.
+
+Usage: python benchmarks/table_update.py [size ...]
+"""
+
+from __future__ import annotations
+import sys
+import asyncio
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1].joinpath('textualncm')))
+from textual.app import App  # noqa: E402
+from _table import TrackTable  # noqa: E402
+from _track import Track  # noqa: E402
+
+
+class Bench(App):
+    def compose(self):
+        yield TrackTable()
+
+
+def rebuild(table: TrackTable):
+    table.clear()
+    for track in table.tracks:
+        table.add_row(*table.row(track), key=str(track.id))
+
+
+async def measure(size: int) -> tuple[float, float]:
+    tracks = [Track(f'Track {i}', i, {1: 'Artist'}, 'Album', 1) for i in range(size)]
+    extra = Track('Liked', size, {1: 'Artist'}, 'Album', 1)
+    results = []
+    app = Bench()
+    async with app.run_test():
+        table = app.query_one(TrackTable)
+        for update in (rebuild, TrackTable.update):
+            table.tracks = list(tracks)
+            table.update()
+            table.on_idle()
+            table.tracks.insert(0, extra)
+            start = time.perf_counter()
+            update(table)
+            table.on_idle()
+            results.append(time.perf_counter() - start)
+    return results[0], results[1]
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000, 20000]
+    print(f'{"rows":>8} {"rebuild":>12} {"diff":>12}')
+    for size in sizes:
+        full, diff = asyncio.run(measure(size))
+        print(f'{size:>8} {full * 1000:>10.1f}ms {diff * 1000:>10.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+"""Measure construction time and memory of Track instances
+
+Usage: python benchmarks/track_memory.py [count]
+"""
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1].joinpath('textualncm')))
+from _track import Track  # noqa: E402
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    payload = [(f'Track {i}', i, {i % 500: f'Artist {i % 500}'}, f'Album {i % 2000}', i % 2000)
+               for i in range(number)]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    tracks = [Track(*args) for args in payload]
+    elapsed = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'{len(tracks)} tracks')
+    print(f'construction: {elapsed * 1000:8.1f} ms ({elapsed / number * 1e6:.2f} us per track)')
+    print(f'memory:       {memory / 2 ** 20:8.1f} MiB ({memory / number:.0f} bytes per track)')
+
+
+if __name__ == '__main__':
+    main()
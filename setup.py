@@ -11,7 +11,7 @@ build_options = {'packages': [], 'excludes': [],
 base = 'console'
 
 executables = [
-    Executable('textualncm/app.py', base=base, target_name = 'TextualNCM')
+    Executable('textualncm/main.py', base=base, target_name = 'TextualNCM')
 ]
 
 setup(name='TextualNCM',
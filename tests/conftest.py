@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The app's modules import each other by their bare names
+sys.path.insert(0, str(Path(__file__).parent.parent / 'textualncm'))
@@ -0,0 +1,146 @@
+import random
+import pytest
+from _playqueue import Queue
+from _track import Track
+
+
+@pytest.fixture
+def tracks():
+    return [Track(f'Track {i}', i, {1: 'Artist'}, 'Album', 1) for i in range(10)]
+
+
+@pytest.fixture
+def queue(tracks):
+    queue = Queue()
+    queue.load(tracks)
+    return queue
+
+
+def ids(queue, count):
+    return [queue.next().id for _ in range(count)]
+
+
+def test_sequence_wraps_around(queue, tracks):
+    queue.jump(tracks[8])
+    assert ids(queue, 3) == [9, 0, 1]
+
+
+def test_play_next_goes_on_after_the_current_track(queue, tracks):
+    queue.jump(tracks[4])
+    extra = Track('Extra', 99, {1: 'Artist'}, 'Album', 1)
+    queue.play_next(extra)
+    assert [track.id for track in queue.peek(3)] == [99, 5, 6]
+    assert ids(queue, 3) == [99, 5, 6]
+
+
+def test_play_next_of_a_queued_track_skips_nothing(queue, tracks):
+    queue.jump(tracks[4])
+    queue.play_next(tracks[8])
+    assert ids(queue, 5) == [8, 5, 6, 7, 8]
+
+
+def test_play_next_plays_the_latest_first(queue, tracks):
+    queue.jump(tracks[0])
+    queue.play_next(tracks[7])
+    queue.play_next(tracks[3])
+    assert ids(queue, 3) == [3, 7, 1]
+
+
+def test_going_back_over_tracks_up_next(queue, tracks):
+    queue.jump(tracks[4])
+    queue.play_next(tracks[8])
+    assert ids(queue, 2) == [8, 5]
+    assert queue.prev().id == 8
+    assert queue.prev().id == 4
+    assert ids(queue, 3) == [8, 5, 6]
+
+
+def test_first_track_up_next(queue, tracks):
+    queue.play_next(tracks[5])
+    assert ids(queue, 2) == [5, 0]
+
+
+def test_remove_current(queue, tracks):
+    queue.jump(tracks[4])
+    queue.remove(tracks[4])
+    assert queue.current is None
+    assert ids(queue, 2) == [5, 6]
+
+
+def test_remove_current_then_compact(queue, tracks):
+    queue.jump(tracks[4])
+    for track in tracks[:6]:
+        queue.remove(track)
+    assert not queue.holes
+    assert ids(queue, 3) == [6, 7, 8]
+
+
+def test_remove_keeps_position_after_up_next(queue, tracks):
+    queue.jump(tracks[4])
+    queue.play_next(tracks[9])
+    assert queue.next().id == 9
+    for track in tracks[:4]:
+        queue.remove(track)
+    queue.remove(tracks[5])
+    assert queue.index(tracks[6]) == 1
+    assert ids(queue, 2) == [6, 7]
+
+
+def test_removed_tracks_are_skipped(queue, tracks):
+    queue.jump(tracks[2])
+    queue.play_next(tracks[6])
+    queue.remove(tracks[3])
+    queue.remove(tracks[6])
+    assert ids(queue, 2) == [4, 5]
+
+
+def test_shuffle_plays_each_track_once_per_round(queue, tracks):
+    random.seed(1)
+    queue.set_shuffle(True)
+    first = ids(queue, 10)
+    assert sorted(first) == list(range(10))
+    second = ids(queue, 10)
+    assert sorted(second) == list(range(10))
+    # A new round does not start with the track that ended the last
+    assert second[0] != first[-1]
+
+
+def test_shuffle_keeps_the_current_track(queue, tracks):
+    random.seed(2)
+    queue.jump(tracks[3])
+    queue.set_shuffle(True)
+    assert queue.current is tracks[3]
+    assert sorted(ids(queue, 9)) == [i for i in range(10) if i != 3]
+
+
+def test_shuffle_with_play_next(queue, tracks):
+    random.seed(3)
+    queue.set_shuffle(True)
+    played = ids(queue, 3)
+    unplayed = [i for i in range(10) if i not in played]
+    queue.play_next(tracks[unplayed[0]])
+    rest = ids(queue, 7)
+    assert rest[0] == unplayed[0]
+    # Played up next, it is not drawn again in this round
+    assert sorted(played + rest) == list(range(10))
+
+
+def test_shuffle_picks_up_appended_tracks(tracks):
+    random.seed(4)
+    queue = Queue()
+    listed = tracks[:5]
+    queue.load(listed)
+    queue.set_shuffle(True)
+    played = ids(queue, 2)
+    listed.extend(tracks[5:])
+    queue.load(listed)
+    assert sorted(played + ids(queue, 8)) == list(range(10))
+
+
+def test_history_is_replayed_after_going_back(queue, tracks):
+    random.seed(5)
+    queue.set_shuffle(True)
+    played = ids(queue, 4)
+    queue.prev()
+    queue.prev()
+    assert ids(queue, 2) == played[2:]
@@ -0,0 +1,143 @@
+from __future__ import annotations
+import os
+import sys
+import shutil
+from collections import OrderedDict
+from threading import Lock
+from pathlib import Path
+
+
+if getattr(sys, "frozen", False):
+    datadir = Path(sys.executable).parent
+else:
+    datadir = Path(__file__).parent
+
+# Upper bound for the total size of completely cached tracks
+CACHE_LIMIT = 2 ** 30
+
+
+class AudioCache:
+    """Size-bounded on-disk cache of streamed audio with LRU eviction
+
+    Tracks are written to '<id>.part' as they stream. A part file holds a
+    prefix of the track and can be resumed by a later stream. Once it reaches
+    the full size it becomes '<id>.mp3'. Both count towards the size limit,
+    part files are evicted first.
+    """
+
+    def __init__(self, root: Path, limit: int = CACHE_LIMIT):
+        self.root = root
+        self.limit = limit
+        self.lock = Lock()
+        self.writing: set[int] = set()
+        if not root.exists():
+            root.mkdir(parents=True)
+        files = sorted(root.glob('*.mp3'), key=lambda path: path.stat().st_mtime)
+        self.entries: OrderedDict[int, int] = OrderedDict(
+            (int(path.stem), path.stat().st_size) for path in files)
+        parts = sorted(root.glob('*.part'), key=lambda path: path.stat().st_mtime)
+        self.parts: OrderedDict[int, int] = OrderedDict(
+            (int(path.stem), path.stat().st_size) for path in parts)
+        self.evict()
+
+    def path(self, track_id: int) -> Path:
+        return self.root.joinpath(f'{track_id}.mp3')
+
+    def part(self, track_id: int) -> Path:
+        return self.root.joinpath(f'{track_id}.part')
+
+    def get(self, track_id: int) -> Path | None:
+        """Return the path of a completely cached track and mark it as recently used"""
+        with self.lock:
+            if track_id not in self.entries:
+                return None
+            self.entries.move_to_end(track_id)
+        path = self.path(track_id)
+        # The modification time keeps the recency order across sessions
+        path.touch()
+        return path
+
+    def prefix(self, track_id: int) -> int:
+        """Number of leading bytes of a track held in its part file"""
+        try:
+            return self.part(track_id).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def writer(self, track_id: int, offset: int, total: int):
+        """Return a Writer appending at offset, or None if that would leave a gap
+
+        A writer at offset 0 starts the part file over. Only one writer per
+        track exists at a time.
+        """
+        with self.lock:
+            if track_id in self.writing or track_id in self.entries:
+                return None
+            if offset and offset != self.prefix(track_id):
+                return None
+            self.writing.add(track_id)
+        return Writer(self, track_id, offset, total)
+
+    def commit(self, track_id: int) -> None:
+        path = self.path(track_id)
+        os.replace(self.part(track_id), path)
+        with self.lock:
+            self.parts.pop(track_id, None)
+            self.entries[track_id] = path.stat().st_size
+            self.evict()
+
+    def keep(self, track_id: int) -> None:
+        """Count an incomplete part file towards the limit, as the most recent one"""
+        with self.lock:
+            self.parts[track_id] = self.prefix(track_id)
+            self.parts.move_to_end(track_id)
+            self.evict()
+
+    def evict(self) -> None:
+        size = sum(self.entries.values()) + sum(self.parts.values())
+        # Part files only save the start of a stream, they go first, oldest first
+        for track_id in list(self.parts):
+            if size <= self.limit:
+                return
+            if track_id not in self.writing:
+                size -= self.parts.pop(track_id)
+                self.part(track_id).unlink(missing_ok=True)
+        while len(self.entries) > 1 and size > self.limit:
+            track_id, entry = self.entries.popitem(last=False)
+            size -= entry
+            self.path(track_id).unlink(missing_ok=True)
+
+    def promote(self, track_id: int, dst: Path | str) -> bool:
+        """Move a completely cached track to dst, returning whether it was cached"""
+        with self.lock:
+            if track_id not in self.entries:
+                return False
+            del self.entries[track_id]
+        shutil.move(self.path(track_id), dst)
+        return True
+
+
+class Writer:
+    def __init__(self, cache: AudioCache, track_id: int, offset: int, total: int):
+        self.cache = cache
+        self.track_id = track_id
+        self.total = total
+        self.fp = open(cache.part(track_id), 'ab' if offset else 'wb')
+
+    def write(self, chunk: bytes) -> None:
+        self.fp.write(chunk)
+
+    def close(self) -> None:
+        complete = self.fp.tell() == self.total
+        self.fp.close()
+        try:
+            if complete:
+                self.cache.commit(self.track_id)
+        finally:
+            with self.cache.lock:
+                self.cache.writing.discard(self.track_id)
+        if not complete:
+            self.cache.keep(self.track_id)
+
+
+audiocache = AudioCache(datadir.joinpath('cache', 'audio'))
@@ -0,0 +1,208 @@
+from __future__ import annotations
+import sys
+import json
+import time
+import sqlite3
+from datetime import datetime, timedelta
+from functools import wraps
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from _network import network
+
+
+if getattr(sys, "frozen", False):
+    datadir = Path(sys.executable).parent
+else:
+    datadir = Path(__file__).parent
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+def midnight() -> float:
+    """Timestamp of the next date boundary"""
+    tomorrow = datetime.now().date() + timedelta(days=1)
+    return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+
+
+# Lifetime of each kind of payload, either in seconds or as a callable
+# returning the absolute expiry timestamp
+TTL = {
+    'artist_menu': HOUR,
+    'album_menu': HOUR,
+    'playlist_menu': 10 * 60,
+    'artist': DAY,
+    'album': 30 * DAY,
+    'playlist': 10 * 60,
+    'daily': midnight,
+    # Metadata of downloaded tracks, read whatever their age
+    'track': 365 * DAY,
+    'likes': DAY,
+    'lyrics': 30 * DAY,
+}
+# Kinds whose expired payloads are refetched before being returned, online
+HARD = {'daily'}
+
+
+class MetaCache:
+    """Persistent store for API payloads with per-kind expiry"""
+
+    def __init__(self, path: Path):
+        self.lock = Lock()
+        self.listeners = []
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS payloads ('
+                        'kind TEXT, key TEXT, expires REAL, data TEXT, '
+                        'PRIMARY KEY (kind, key))')
+        self.db.commit()
+
+    def get(self, kind: str, key) -> tuple[object, float] | None:
+        """Return the stored payload and its expiry timestamp"""
+        with self.lock:
+            row = self.db.execute('SELECT expires, data FROM payloads WHERE kind=? AND key=?',
+                                  (kind, str(key))).fetchone()
+        if row is None:
+            return None
+        expires, data = row
+        return json.loads(data), expires
+
+    def subscribe(self, listener) -> None:
+        """Call listener with the old and new value whenever a refresh replaces one
+
+        Listeners are called from the thread that refreshed the value.
+        """
+        self.listeners.append(listener)
+
+    def get_many(self, kind: str, keys) -> dict[str, object]:
+        """Stored payloads of the given keys that are present, whatever their expiry"""
+        keys = [str(key) for key in keys]
+        found = {}
+        # SQLite limits the number of parameters of a statement
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            with self.lock:
+                rows = self.db.execute(f'SELECT key, data FROM payloads WHERE kind=? AND key IN '
+                                       f'({",".join("?" * len(chunk))})', (kind, *chunk)).fetchall()
+            found.update((key, json.loads(data)) for key, data in rows)
+        return found
+
+    def put(self, kind: str, key, payload) -> float:
+        expires = expiry(kind)
+        data = json.dumps(payload, ensure_ascii=False)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO payloads VALUES (?, ?, ?, ?)',
+                            (kind, str(key), expires, data))
+            self.db.commit()
+        return expires
+
+    def put_many(self, kind: str, payloads: dict) -> None:
+        expires = expiry(kind)
+        rows = [(kind, str(key), expires, json.dumps(payload, ensure_ascii=False))
+                for key, payload in payloads.items()]
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO payloads VALUES (?, ?, ?, ?)', rows)
+            self.db.commit()
+
+    def invalidate(self, kind: str, key=None) -> None:
+        """Expire one payload, or every payload of a kind when key is None"""
+        with self.lock:
+            if key is None:
+                self.db.execute('DELETE FROM payloads WHERE kind=?', (kind,))
+            else:
+                self.db.execute('DELETE FROM payloads WHERE kind=? AND key=?', (kind, str(key)))
+            self.db.commit()
+        # In-memory values are kept so that widgets holding them stay valid,
+        # they are refreshed in the background on their next lookup
+        for expires in _expiries.get(kind, ()):
+            if key is None:
+                expires.clear()
+            else:
+                expires.pop(str(key), None)
+
+
+def expiry(kind: str) -> float:
+    ttl = TTL.get(kind, HOUR)
+    return ttl() if callable(ttl) else time.time() + ttl
+
+
+metacache = MetaCache(datadir.joinpath('cache.db'))
+refresher = ThreadPoolExecutor(max_workers=2)
+_expiries: dict[str, list[dict]] = {}
+
+
+def cached(kind: str, parse=None):
+    """Cache the JSON payload returned by a single-argument fetch function
+
+    Results are kept in memory for the session and persisted in the metacache.
+    An expired payload is still returned immediately while a fresh copy is
+    fetched in the background, except for the HARD kinds. If given, 'parse' converts the raw payload
+    into the value handed to callers.
+    """
+    def decorator(fetch):
+        memo: dict = {}
+        expires: dict[str, float] = {}
+        pending: set[str] = set()
+        _expiries.setdefault(kind, []).append(expires)
+
+        def store(key, payload, until, value=None):
+            if value is None:
+                value = parse(payload) if parse else payload
+            # Values handed out are never changed, subscribers are told of the new one
+            memo[key] = value
+            expires[key] = until
+
+        def refresh(key, arg):
+            try:
+                # Offline, cached payloads are served whatever their age
+                network.require()
+                payload = fetch(arg)
+                old = memo.get(key)
+                store(key, payload, metacache.put(kind, key, payload))
+            except Exception as exc:
+                network.check(exc)
+                raise
+            finally:
+                pending.discard(key)
+            if old is not None:
+                for listener in metacache.listeners:
+                    listener(old, memo[key])
+            return memo[key]
+
+        def refresh_later(key, arg):
+            if key not in pending:
+                pending.add(key)
+                refresher.submit(refresh, key, arg)
+
+        @wraps(fetch)
+        def wrapper(arg=0):
+            key = str(arg)
+            if key not in memo:
+                hit = metacache.get(kind, key)
+                if hit is None:
+                    return refresh(key, arg)
+                payload, until = hit
+                store(key, payload, until)
+            if expires.get(key, 0) <= time.time():
+                if kind not in HARD or not network.online:
+                    refresh_later(key, arg)
+                    return memo[key]
+                try:
+                    return refresh(key, arg)
+                except Exception as exc:
+                    # Offline, the expired payload is better than nothing
+                    if not network.check(exc):
+                        raise
+            return memo[key]
+
+        def put(arg, payload, value=None):
+            """Store a payload fetched elsewhere, optionally with its parsed value"""
+            key = str(arg)
+            store(key, payload, metacache.put(kind, key, payload), value)
+
+        wrapper.refresh = lambda arg=0: refresh(str(arg), arg)
+        wrapper.put = put
+        wrapper.is_cached = lambda arg=0: str(arg) in memo or metacache.get(kind, arg) is not None
+        return wrapper
+    return decorator
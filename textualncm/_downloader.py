@@ -1,34 +1,307 @@
+from __future__ import annotations
+import os
+import time
+import heapq
+import hashlib
 from _track import Track
-from pyncm import apis, GetCurrentSession
-from concurrent.futures import ThreadPoolExecutor
+from _audiocache import audiocache
+from _resolver import resolver
+from _library import library
+from _streaming import streaming
+from _trace import tracer
+from _network import network
+from _cache import metacache
+from _tagger import tagger
+from pyncm import GetCurrentSession
+from requests import RequestException
+from itertools import count
+from threading import Condition, Event, Lock, Thread
+
+CHUNK = 128 * 2 ** 10
+RETRIES = 4
+# Seconds to wait before the first retry, doubled for each following one
+BACKOFF = 1
+
+# Job priorities, lower runs first
+PLAYING = 0  # The track currently playing
+SINGLE = 1   # Tracks downloaded one by one
+BULK = 2     # Tracks of a downloaded playlist
+
+MAX_WORKERS = 6
+# Seconds between concurrency adjustments
+WINDOW = 5
+# Bytes per second left to downloads while the player streams
+STREAM_RATE = 256 * 2 ** 10
+# Seconds between progress events of a transfer
+REPORT_INTERVAL = 0.25
+
+
+class Shaper:
+    """Meters download throughput and caps it while the player is streaming"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.total = 0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+
+    def consume(self, size: int) -> None:
+        with self.lock:
+            self.total += size
+            if not streaming:
+                return
+            now = time.monotonic()
+            self.tokens = min(STREAM_RATE, self.tokens + (now - self.stamp) * STREAM_RATE) - size
+            self.stamp = now
+            delay = -self.tokens / STREAM_RATE if self.tokens < 0 else 0
+        time.sleep(delay)
 
 
 class Downloader:
+    """Runs download jobs by priority with an adaptive number of workers
+
+    The number of concurrent transfers grows while it improves throughput and
+    shrinks when it stops doing so. While the player streams from the proxy
+    only one transfer runs and its bandwidth is capped. Offline, jobs wait in
+    the queue, and those interrupted go back to it.
+    """
+
     def __init__(self):
-        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.queue: list[tuple[int, int, Track]] = []
+        self.priorities: dict[int, int] = {}
+        self.order = count()
+        self.cond = Condition()
+        self.running = 0
+        self.limit = 2
+        self.completed = 0
+        self.failed = 0
+        self.throughput = 0.0
+        self.shaper = Shaper()
+        network.subscribe(self.reconnected)
+        self.workers = [Thread(target=self.work, daemon=True) for _ in range(MAX_WORKERS)]
+
+    def start(self):
+        # Jobs submitted before wait in the queue
+        for worker in self.workers:
+            worker.start()
+        Thread(target=self.monitor, daemon=True).start()
 
     def shutdown(self):
-        self.executor.shutdown(wait=True)
+        # Interrupted transfers keep their part files and resume next time
+        stopping.set()
+        with self.cond:
+            self.queue.clear()
+            self.cond.notify_all()
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join()
 
-    def submit(self, track: Track):
-        if track.downloading:
-            return
-        self.executor.submit(download, track)
+    def submit(self, track: Track, priority: int = SINGLE):
+        with self.cond:
+            # A queued track may be submitted again with a higher priority,
+            # its old entry is skipped when popped
+            if priority >= self.priorities.get(track.id, BULK + 1) or track.local:
+                return
+            if track.downloading and track.id not in self.priorities:
+                return
+            self.priorities[track.id] = priority
+            track.downloading = True
+            heapq.heappush(self.queue, (priority, next(self.order), track))
+            self.cond.notify()
+        publish(track)
+
+    def subscribe(self, listener) -> None:
+        """Call listener with a track whenever its download progresses
+
+        Events are published from download threads, at most a few per second
+        per transfer plus one when it is queued and one when it ends.
+        """
+        listeners.append(listener)
+
+    def submit_many(self, tracks: list[Track]):
+        # Resolve every URL up front so that they are fetched in a few batches
+        resolver.prefetch(track.id for track in tracks if not track.downloading)
+        for track in tracks:
+            self.submit(track, BULK)
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {'queued': len(self.priorities),
+                    'running': self.running,
+                    'limit': self.limit,
+                    'throughput': self.throughput,
+                    'completed': self.completed,
+                    'failed': self.failed}
+
+    def reconnected(self, online: bool) -> None:
+        if online:
+            with self.cond:
+                self.cond.notify_all()
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not stopping.is_set() and not (self.queue and self.running < self.allowed()
+                                                     and network.online):
+                    self.cond.wait()
+                if stopping.is_set():
+                    return
+                priority, _, track = heapq.heappop(self.queue)
+                if self.priorities.get(track.id) != priority:
+                    continue
+                del self.priorities[track.id]
+                self.running += 1
+                requeue = False
+            try:
+                download(track, self.shaper)
+            except Exception:  # noqa
+                # A failed job must not take its worker down, it is counted below
+                pass
+            finally:
+                with self.cond:
+                    self.running -= 1
+                    if track.local:
+                        self.completed += 1
+                    elif not network.online:
+                        requeue = True
+                    elif not stopping.is_set():
+                        self.failed += 1
+                    self.cond.notify_all()
+                if requeue:
+                    self.submit(track, priority)
+
+    def allowed(self) -> int:
+        return 1 if streaming else self.limit
 
+    def monitor(self):
+        last = 0
+        while not stopping.wait(WINDOW):
+            total = self.shaper.total
+            throughput = (total - last) / WINDOW
+            last = total
+            with self.cond:
+                # Grow while throughput keeps improving, shrink when it drops
+                if self.running >= self.limit and throughput > self.throughput * 1.05:
+                    self.limit = min(self.limit + 1, MAX_WORKERS)
+                elif throughput < self.throughput * 0.8:
+                    self.limit = max(self.limit - 1, 1)
+                self.throughput = throughput
+                self.cond.notify_all()
 
-def download(track: Track):
+
+class ExpiredError(Exception):
+    """The signed URL has expired since it was resolved"""
+
+
+class VerificationError(Exception):
+    """The downloaded file does not match the size or md5 given by the API"""
+
+
+stopping = Event()
+listeners: list = []
+
+
+def publish(track: Track) -> None:
+    for listener in listeners:
+        listener(track)
+
+
+def download(track: Track, shaper: Shaper):
     track.downloading = True
-    track_id = [track.id]
-    audio = apis.track.GetTrackAudioV1(track_id, level='exhigh')
-    audio = audio.get("data", [{"url": ""}])[0]
-    if not audio['url']:
-        return
-    response = GetCurrentSession().get(audio['url'], stream=True)
-    track.size = int(response.headers.get("content-length"))
-    dst = rf'downloads/{track_id[0]}.mp3'
-    with open(dst, 'wb') as fp:
-        for chunk in response.iter_content(128 * 2 ** 10):
+    dst = str(library.file(track.id))
+    try:
+        if audiocache.promote(track.id, dst):
+            track.local = True
+            return
+
+        fresh = False
+        for attempt in range(RETRIES + 1):
+            if attempt:
+                time.sleep(BACKOFF * 2 ** (attempt - 1))
+            audio = resolver.resolve(track.id, fresh=fresh)
+            if not audio['url']:
+                return
+            try:
+                with tracer.span('download', 'download') as event:
+                    track.local = fetch(track, audio, dst, shaper, event)
+                return
+            except ExpiredError:
+                fresh = True
+            except (RequestException, OSError, VerificationError) as exc:
+                if network.check(exc):
+                    return
+                fresh = False
+            if stopping.is_set():
+                return
+    finally:
+        track.downloading = False
+        if track.local:
+            # Local tracks are listed offline from their stored metadata
+            metacache.put('track', track.id, track.payload())
+            tagger.submit(track.id)
+        publish(track)
+
+
+def fetch(track: Track, audio: dict, dst: str, shaper: Shaper, event: dict) -> bool:
+    """Download to a part file, resuming it if present, then verify and rename it
+
+    Returns False if the downloader was stopped before the transfer completed.
+    """
+    part = dst + '.part'
+    md5 = hashlib.md5()
+    track.size = audio.get('size', 0)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    response = GetCurrentSession().get(audio['url'], stream=True, headers=headers)
+    with response:
+        if response.status_code in (403, 404):
+            raise ExpiredError
+        if response.status_code != 416:
+            # 416 means the part file already holds the whole track
+            response.raise_for_status()
+            if response.status_code != 206:
+                # The server ignored the range, start over
+                offset = 0
+            if not write(track, response, part, offset, md5, shaper, event):
+                return False
+        else:
+            hash_file(part, md5)
+
+    size = os.path.getsize(part)
+    if audio.get('size') and size < audio['size']:
+        # Truncated transfer, resume it on the next attempt
+        raise VerificationError(f'{track.id}: {size} of {audio["size"]} bytes')
+    expected = audio.get('md5')
+    if (audio.get('size') and size != audio['size']) or (expected and md5.hexdigest() != expected.lower()):
+        os.remove(part)
+        raise VerificationError(f'{track.id}: {size} bytes, md5 {md5.hexdigest()}')
+    os.replace(part, dst)
+    library.add(track.id, size, audio.get('level'))
+    return True
+
+
+def write(track: Track, response, part: str, offset: int, md5, shaper: Shaper, event: dict) -> bool:
+    with open(part, 'ab' if offset else 'wb') as fp:
+        if offset:
+            hash_file(part, md5)
+        track.size = track.size or int(response.headers.get('content-length')) + offset
+        track.xfered = offset
+        reported = 0.0
+        for chunk in response.iter_content(CHUNK):
+            if stopping.is_set():
+                return False
             fp.write(chunk)
+            md5.update(chunk)
             track.xfered += len(chunk)
-    track.local = True
-    track.downloading = False
+            event['bytes'] += len(chunk)
+            shaper.consume(len(chunk))
+            if (now := time.monotonic()) - reported >= REPORT_INTERVAL:
+                reported = now
+                publish(track)
+    return True
+
+
+def hash_file(path: str, md5) -> None:
+    with open(path, 'rb') as fp:
+        while chunk := fp.read(CHUNK):
+            md5.update(chunk)
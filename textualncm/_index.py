@@ -0,0 +1,357 @@
+from __future__ import annotations
+import re
+import unicodedata
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from functools import lru_cache
+from threading import Lock, Timer
+
+# Seconds to wait for more tracks before indexing them
+WINDOW = 0.2
+# Tracks indexed per lock acquisition, so that a search never waits long
+CHUNK = 1000
+# Most tracks returned by a search
+LIMIT = 200
+# Longest words that may match holding only two of their grams, once checked
+SHORT = 6
+
+HAN = '㐀-䶿一-鿿豈-﫿'
+WORDS = re.compile(rf'[{HAN}]+|[^\W_{HAN}]+')
+HAN_WORD = re.compile(rf'[{HAN}]+')
+
+
+def words(text: str) -> list[str]:
+    """Split text into case-folded words, a run of Chinese characters is one word"""
+    return WORDS.findall(unicodedata.normalize('NFKC', text).casefold())
+
+
+def grams(word: str) -> list[str]:
+    # Padding the start marks word boundaries, so a word shorter than three
+    # characters still has grams and prefixes weigh more than infixes
+    padded = '  ' + word
+    return [padded[i:i + 3] for i in range(len(word))]
+
+
+def document(track) -> set[str]:
+    """All grams a track is found by"""
+    return text_grams(track.name) | text_grams(track.artists) | text_grams(track.album)
+
+
+@lru_cache(maxsize=4096)
+def text_grams(text: str) -> frozenset[str]:
+    # Artists and albums repeat across tracks, their grams are worked out once
+    found = set()
+    for word in words(text):
+        if HAN_WORD.fullmatch(word):
+            found.update(han_grams(word))
+            if pinyin():
+                found.update(pinyin_grams(word))
+        else:
+            found.update(grams(word))
+    return frozenset(found)
+
+
+def han_grams(word: str) -> list[str]:
+    # Chinese is not separated by spaces, so every character may start a word
+    found = []
+    for i in range(len(word)):
+        found.extend(grams(word[i:i + 3]))
+    return found
+
+
+@lru_cache(maxsize=None)
+def pinyin():
+    # pypinyin loads its dictionaries when imported, which would take about
+    # half of the imports before the first frame, so it is imported on the
+    # first Chinese word indexed. None without pypinyin
+    try:
+        from pypinyin import lazy_pinyin
+    except ImportError:
+        return None
+    return lazy_pinyin
+
+
+@lru_cache(maxsize=None)
+def syllable(char: str) -> str:
+    # Looked up per character, with its most common reading: converting whole
+    # words segments them into phrases, which is a hundred times slower
+    found = pinyin()(char)
+    return found[0] if found and found[0].isascii() else ''
+
+
+def spellings(word: str) -> list[str]:
+    # Syllables on their own, joined together and as initials, so that 七里香
+    # is found by xiang, qilixiang and qlx
+    syllables = [s for s in map(syllable, word) if s]
+    if len(syllables) > 1:
+        return [*syllables, ''.join(syllables), ''.join(s[0] for s in syllables)]
+    return syllables
+
+
+def pinyin_grams(word: str) -> list[str]:
+    found = []
+    for spelled in spellings(word):
+        found.extend(grams(spelled))
+    return found
+
+
+@lru_cache(maxsize=4096)
+def text_terms(text: str) -> frozenset[str]:
+    """Words of text a query word may be the start of, as text_grams indexes them"""
+    found = set()
+    for word in words(text):
+        if HAN_WORD.fullmatch(word):
+            found.update(word[i:] for i in range(len(word)))
+            if pinyin():
+                found.update(spellings(word))
+        else:
+            found.add(word)
+    return frozenset(found)
+
+
+def one_edit(query: str, word: str) -> bool:
+    """Whether a prefix of word is at most one substitution, insertion,
+    deletion or swap of adjacent characters away from query"""
+    for i, (a, b) in enumerate(zip(query, word)):
+        if a != b:
+            break
+    else:
+        # query starts word, or word is query without its last character
+        return len(word) >= len(query) - 1
+    rest = query[i + 1:]
+    return (word.startswith(rest, i + 1) or word.startswith(query[i:], i + 1)
+            or word.startswith(rest, i)
+            or query[i + 1:i + 2] == b and word[i + 1:i + 2] == a and word.startswith(query[i + 2:], i + 2))
+
+
+def holds(posting: list[int], doc: int) -> bool:
+    # Documents are appended in increasing order, so every list is sorted
+    i = bisect_left(posting, doc)
+    return i < len(posting) and posting[i] == doc
+
+
+def intersect(postings: list[list[int]], limit: int | None = None) -> list[int]:
+    """The first limit documents held by every list, in order"""
+    postings = sorted(postings, key=len)
+    rarest = postings[0]
+    found = []
+    # The rarest list is walked in chunks of growing size, and the other lists
+    # only in the range of a chunk, so a search stops soon after limit is
+    # reached without going through the common grams' long lists
+    start, size = 0, len(rarest) if limit is None else max(limit, 1) * 2
+    while start < len(rarest) and (limit is None or len(found) < limit):
+        chunk = rarest[start:start + size]
+        docs = set(chunk)
+        for posting in postings[1:]:
+            low, high = bisect_left(posting, chunk[0]), bisect_right(posting, chunk[-1])
+            if len(docs) * 16 < high - low:
+                docs = {doc for doc in docs if holds(posting, doc)}
+            else:
+                docs.intersection_update(posting[low:high])
+            if not docs:
+                break
+        found.extend(sorted(docs))
+        start += size
+        size *= 2
+    return found[:limit]
+
+
+def count(postings: list[list[int]], required: int, within=None) -> dict[int, int]:
+    """Documents in at least required of the lists, with the number they are in"""
+    if within is not None and len(within) * len(postings) * 16 < sum(map(len, postings)):
+        # Few documents left, look them up in the sorted lists rather than
+        # counting every list
+        found = {}
+        for doc in within:
+            held = sum(holds(posting, doc) for posting in postings)
+            if held >= required:
+                found[doc] = held
+        return found
+
+    postings = sorted(postings, key=len)
+    if within is None:
+        # A document holding the required number of grams appears in at least
+        # one of the rarest len(postings) - required + 1 lists
+        candidates = set().union(*postings[:len(postings) - required + 1])
+    else:
+        candidates = set(within)
+    if required == len(postings):
+        for posting in postings[within is None:]:
+            candidates.intersection_update(posting)
+        return dict.fromkeys(candidates, required)
+    # Only the candidates are counted, the lists of common grams are long
+    scores = Counter()
+    for posting in postings:
+        scores.update(candidates.intersection(posting))
+    return {doc: held for doc, held in scores.items() if held >= required}
+
+
+class Index:
+    """In-memory n-gram index over every track the client has seen
+
+    Lists of tracks are registered as they are parsed from the API and
+    indexed in the background shortly after. Queries match word prefixes anywhere in the
+    name, artists or album of a track and tolerate a few typos, ranking
+    tracks by the number of query grams they contain.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.tracks = []
+        self.ids: set[int] = set()
+        self.postings: defaultdict[str, list[int]] = defaultdict(list)
+        # Tracks waiting to be indexed have their own lock, so that parsing
+        # tracks never waits for indexing
+        self.pending_lock = Lock()
+        self.pending = []
+        self.timer: Timer | None = None
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def add(self, tracks: list) -> None:
+        with self.pending_lock:
+            self.pending.extend(tracks)
+            if self.timer is None:
+                self.timer = Timer(WINDOW, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self) -> None:
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+            self.timer = None
+        for i in range(0, len(pending), CHUNK):
+            with self.lock:
+                for track in pending[i:i + CHUNK]:
+                    if track.id in self.ids:
+                        continue
+                    self.ids.add(track.id)
+                    doc = len(self.tracks)
+                    self.tracks.append(track)
+                    for gram in document(track):
+                        self.postings[gram].append(doc)
+
+    def match(self, query: str, limit: int | None = None) -> list[int]:
+        """Documents matching every word of query, best first
+
+        Documents holding all grams of the query come first, in the order
+        they were seen. Those missing a few, because of a typo, follow by
+        the number of grams they hold, unless limit is already reached.
+        """
+        self.flush()
+        tokens = list(dict.fromkeys(words(query)))
+        if not tokens:
+            return []
+        with self.lock:
+            postings = [self.postings_of(token) for token in tokens]
+            best = intersect([p for ps in postings for p in ps], limit)
+            typos = [len(token) // 4 for token in tokens]
+            if not any(typos) or limit is not None and len(best) >= limit:
+                return best
+
+            # Words matched exactly narrow down the documents first, by their
+            # rarest gram, so that the grams of the others are only looked up
+            # for those left. Their other grams are checked last, only on the
+            # documents shown. A single word stops once it has found limit
+            scores = None
+            single = limit if len(tokens) == 1 else None
+            deferred = []
+            for token, posting, typo in sorted(zip(tokens, postings, typos), key=lambda entry: entry[2]):
+                if not typo:
+                    posting = sorted(posting, key=len)
+                    deferred.extend(posting[1:])
+                    posting = posting[:1]
+                found = self.near(token, posting, typo, scores, single)
+                # Found among the documents left, if any
+                scores = found if scores is None else {doc: scores[doc] + held for doc, held in found.items()}
+                if not scores:
+                    return best
+            for doc in best:
+                scores.pop(doc, None)
+            # By the number of grams held, then in the order seen
+            ranked = sorted(scores)
+            ranked.sort(key=scores.__getitem__, reverse=True)
+            for doc in ranked:
+                if limit is not None and len(best) >= limit:
+                    break
+                if all(holds(posting, doc) for posting in deferred):
+                    best.append(doc)
+        return best
+
+    def postings_of(self, word: str) -> list[list[int]]:
+        return [self.postings.get(gram, []) for gram in dict.fromkeys(grams(word))]
+
+    def near(self, word: str, postings: list[list[int]], typos: int, within=None,
+             limit: int | None = None) -> dict[int, int]:
+        """Documents holding enough of the grams of a word, with the number they hold
+
+        A substitution breaks up to three grams, typos are tolerated one per
+        four characters. Documents are found by at least half of the grams,
+        or by two of those of a short word when the typo is near its start.
+        Those holding so few may only share the start of the word, so they
+        are kept if they have a word one edit away.
+        """
+        half = (len(postings) + 1) // 2
+        required = max(len(postings) - 3 * typos, half)
+        weak = len(postings) <= SHORT and typos and required > 2
+        if within is not None or limit is None:
+            found = count(postings, required, within)
+            if weak:
+                candidates = count(postings, 2, within)
+                for doc in sorted(candidates):
+                    if doc not in found and self.edited(doc, word):
+                        found[doc] = candidates[doc]
+            return found
+        # Only the first limit documents are shown. When many hold the
+        # required grams, those holding more are counted, being few, and the
+        # others are looked for in the order seen
+        if sum(sorted(map(len, postings))[:len(postings) - required + 1]) <= limit * 8:
+            found = count(postings, required)
+        else:
+            found = count(postings, required + 1)
+            self.walk(found, postings, required, limit)
+        if weak:
+            self.walk(found, postings, 2, limit, word)
+        return found
+
+    def walk(self, found: dict[int, int], postings: list[list[int]], required: int, limit: int,
+             word: str | None = None) -> None:
+        """Add documents holding required of the lists to found, in the order
+        seen, until it has limit of them. With word, only those one edit away"""
+        end = max((posting[-1] + 1 for posting in postings if posting), default=0)
+        # Ranges of growing size, each list is only sliced over the range
+        low, size = 0, limit * 8
+        while low < end and len(found) < limit:
+            high = low + size
+            held = count([posting[bisect_left(posting, low):bisect_left(posting, high)]
+                          for posting in postings], required)
+            for doc in sorted(held):
+                if len(found) >= limit:
+                    return
+                if doc not in found and (word is None or self.edited(doc, word)):
+                    found[doc] = held[doc]
+            low, size = high, size * 2
+
+    def edited(self, doc: int, word: str) -> bool:
+        """Whether a document has a word that starts one edit away from word"""
+        heads = word[:2]
+        track = self.tracks[doc]
+        for text in (track.name, track.artists, track.album):
+            for term in text_terms(text):
+                # One edit away, one of the first two characters is the same
+                if (term[:1] in heads or term[1:2] in heads) and one_edit(word, term):
+                    return True
+        return False
+
+    def search(self, query: str, limit: int = LIMIT) -> list:
+        """Tracks matching query, best first"""
+        return [self.tracks[doc] for doc in self.match(query, limit)[:limit]]
+
+    def filter(self, query: str, tracks: list) -> list:
+        """Tracks of a list matching query, in their order"""
+        ids = {self.tracks[doc].id for doc in self.match(query)}
+        return [track for track in tracks if track.id in ids]
+
+
+index = Index()
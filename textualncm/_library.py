@@ -0,0 +1,126 @@
+from __future__ import annotations
+import os
+import sys
+import json
+from threading import Lock
+from pathlib import Path
+
+
+if getattr(sys, "frozen", False):
+    datadir = Path(sys.executable).parent
+else:
+    datadir = Path(__file__).parent
+downloads = datadir.joinpath('downloads')
+if not downloads.exists():
+    downloads.mkdir()
+
+
+class Library:
+    """Index of downloaded tracks keyed by id, persisted between sessions
+
+    Each entry holds the file size and quality level of a track. At startup
+    the saved index is trusted as long as the modification time of the
+    downloads directory has not changed, so the directory is only listed when
+    files were added or removed outside the index. The ids of tracks whose
+    tags have been written are kept with it.
+    """
+
+    def __init__(self, root: Path, path: Path):
+        self.root = root
+        self.path = path
+        self.lock = Lock()
+        self.mtime = 0.0
+        self.entries: dict[int, tuple[int, str | None]] = {}
+        self.tagged: set[int] = set()
+        try:
+            with open(path) as fp:
+                saved = json.load(fp)
+            self.mtime = saved['mtime']
+            self.entries = {int(k): tuple(v) for k, v in saved['tracks'].items()}
+            self.tagged = set(saved.get('tagged', []))
+        except (OSError, ValueError, KeyError):
+            pass
+        self.refresh()
+
+    def __contains__(self, track_id: int) -> bool:
+        return track_id in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def ids(self) -> list[int]:
+        with self.lock:
+            return list(self.entries)
+
+    def file(self, track_id: int) -> Path:
+        return self.root.joinpath(f'{track_id}.mp3')
+
+    def get(self, track_id: int) -> tuple[int, str | None] | None:
+        return self.entries.get(track_id)
+
+    def add(self, track_id: int, size: int | None = None, level: str | None = None) -> None:
+        if size is None:
+            size = self.file(track_id).stat().st_size
+        with self.lock:
+            self.entries[track_id] = size, level
+            # A new file has no tags yet
+            self.tagged.discard(track_id)
+            self.touch()
+            self.save()
+
+    def remove(self, track_id: int) -> None:
+        with self.lock:
+            self.tagged.discard(track_id)
+            if self.entries.pop(track_id, None) is not None:
+                self.touch()
+                self.save()
+
+    def untagged(self) -> list[int]:
+        with self.lock:
+            return [track_id for track_id in self.entries if track_id not in self.tagged]
+
+    def tag(self, track_id: int) -> None:
+        """Record that the tags of a track were written, which changed its size"""
+        size = self.file(track_id).stat().st_size
+        with self.lock:
+            if track_id in self.entries:
+                self.entries[track_id] = size, self.entries[track_id][1]
+                self.tagged.add(track_id)
+                self.save()
+
+    def refresh(self) -> set[int]:
+        """Rescan the directory if it changed, returning the ids added or removed"""
+        mtime = self.root.stat().st_mtime
+        if mtime == self.mtime:
+            return set()
+        found = {int(path.stem): path for path in self.root.glob('*.mp3') if path.stem.isdigit()}
+        with self.lock:
+            # The app may have added or removed files since they were listed
+            added = {track_id for track_id in found.keys() - self.entries.keys() if found[track_id].exists()}
+            removed = {track_id for track_id in self.entries.keys() - found.keys()
+                       if not self.file(track_id).exists()}
+            for track_id in added:
+                self.entries[track_id] = found[track_id].stat().st_size, None
+            for track_id in removed:
+                del self.entries[track_id]
+                self.tagged.discard(track_id)
+            self.mtime = mtime
+            self.save()
+        return added | removed
+
+    def touch(self) -> None:
+        # Files added or removed by the app are already in the index, so only
+        # later changes to the directory have it listed again
+        self.mtime = self.root.stat().st_mtime
+
+    def save(self) -> None:
+        data = {'mtime': self.mtime,
+                'tracks': {str(k): list(v) for k, v in self.entries.items()},
+                'tagged': sorted(self.tagged)}
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(tmp, self.path)
+
+
+library = Library(downloads, datadir.joinpath('library.json'))
@@ -0,0 +1,172 @@
+from __future__ import annotations
+from pyncm import apis, GetCurrentSession
+from pyncm.apis import WeapiCryptoRequest
+from threading import Lock, Timer
+from _cache import metacache
+from _trace import traced
+from _network import network
+
+# Seconds to wait for more changes before sending them
+WINDOW = 1
+RETRIES = 5
+# Seconds to wait before the first retry, doubled for each following one
+BACKOFF = 2
+
+
+@traced('GetLikeList')
+@WeapiCryptoRequest
+def GetLikeList(uid: int):
+    """Ids of the tracks a user likes"""
+    return '/weapi/song/like/get', {'uid': uid}
+
+
+class Likes:
+    """Ids of the liked tracks, with the changes waiting to be sent
+
+    Liking or unliking a track takes effect locally at once and is sent with
+    the other changes made within a short window. Toggling a track back
+    before then cancels its change. Failures are retried with a growing
+    delay, after the last retry the tracks go back to the server state and
+    listeners are called with their ids. Offline, changes are held until the
+    API can be reached again.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.ids: set[int] = set()
+        # Server state of the tracks with a change to send
+        self.pending: dict[int, bool] = {}
+        self.playlist_id = 0
+        self.failures = 0
+        self.timer: Timer | None = None
+        self.listeners = []
+        network.subscribe(self.reconnected)
+
+    def __contains__(self, track_id: int) -> bool:
+        return track_id in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def load(self) -> set[int]:
+        uid = GetCurrentSession().uid
+        try:
+            network.require()
+            ids = set(GetLikeList(uid).get('ids', []))
+            metacache.put('likes', uid, sorted(ids))
+        except Exception as exc:
+            if not network.check(exc):
+                raise
+            # Offline, the ids last loaded stand in
+            hit = metacache.get('likes', uid)
+            ids = set(hit[0]) if hit else set()
+        saved = metacache.get('likes', 'pending')
+        with self.lock:
+            # Changes held offline in an earlier session
+            for track_id, liked in saved[0] if saved else []:
+                self.pending.setdefault(track_id, liked)
+            # Changes not sent yet still apply
+            for track_id, liked in self.pending.items():
+                if liked:
+                    ids.discard(track_id)
+                else:
+                    ids.add(track_id)
+            self.ids = ids
+            if self.pending:
+                self.schedule(WINDOW)
+        return ids
+
+    def subscribe(self, listener) -> None:
+        """Call listener with a set of ids whenever tracks revert to the server state"""
+        self.listeners.append(listener)
+
+    def toggle(self, track_id: int) -> bool:
+        """Like or unlike a track, returning whether it is liked now"""
+        with self.lock:
+            liked = track_id not in self.ids
+            if liked:
+                self.ids.add(track_id)
+            else:
+                self.ids.discard(track_id)
+            if track_id in self.pending:
+                del self.pending[track_id]
+            else:
+                self.pending[track_id] = not liked
+            self.schedule(WINDOW)
+        return liked
+
+    def schedule(self, delay: float) -> None:
+        if self.timer is None:
+            self.timer = Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def save(self) -> None:
+        # Changes not sent yet outlive the session, for those made offline
+        metacache.put('likes', 'pending', list(self.pending.items()))
+
+    def reconnected(self, online: bool) -> None:
+        if online:
+            with self.lock:
+                if self.pending:
+                    self.schedule(WINDOW)
+
+    def flush(self) -> None:
+        with self.lock:
+            self.timer = None
+            if not network.online:
+                self.save()
+                return
+            batch, self.pending = self.pending, {}
+        failed = {}
+        # Not sent because the API cannot be reached, these are not failures
+        held = {}
+        for track_id, liked in batch.items():
+            if not network.online:
+                held[track_id] = liked
+                continue
+            try:
+                result = apis.track.SetLikeTrack(track_id, like=not liked)
+                if result.get('code') != 200:
+                    failed[track_id] = liked
+            except Exception as exc:
+                if network.check(exc):
+                    held[track_id] = liked
+                else:
+                    failed[track_id] = liked
+        if len(failed) + len(held) < len(batch):
+            metacache.invalidate('playlist', self.playlist_id)
+
+        reverted = set()
+        with self.lock:
+            if not failed and not held:
+                self.failures = 0
+                self.save()
+                return
+            if failed:
+                self.failures += 1
+            for track_id, liked in {**held, **failed}.items():
+                # Toggled again in the meantime, the server state is still the
+                # one before the batch
+                if (track_id in self.ids) == liked:
+                    self.pending.pop(track_id, None)
+                elif track_id in failed and self.failures > RETRIES:
+                    self.pending.pop(track_id, None)
+                    reverted.add(track_id)
+                    if liked:
+                        self.ids.add(track_id)
+                    else:
+                        self.ids.discard(track_id)
+                else:
+                    self.pending[track_id] = liked
+            if self.failures > RETRIES:
+                self.failures = 0
+            if self.pending and network.online:
+                self.schedule(BACKOFF * 2 ** (self.failures - 1) if self.failures else WINDOW)
+            self.save()
+        if reverted:
+            for listener in self.listeners:
+                listener(reverted)
+
+
+likes = Likes()
@@ -0,0 +1,45 @@
+from __future__ import annotations
+import re
+from bisect import bisect_right
+from pyncm import apis
+from _cache import cached
+
+# Time tags of an LRC line, [mm:ss.xx], a line may start with several
+TAG = re.compile(r'\[(\d+):(\d+(?:\.\d+)?)]')
+
+
+class Lyrics:
+    """Lines of a track sorted by the time they start, in milliseconds"""
+    __slots__ = ('times', 'lines')
+
+    def __init__(self, times: list[int], lines: list[str]):
+        self.times = times
+        self.lines = lines
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def index(self, time: int) -> int:
+        """The line sung at time, -1 before the first one"""
+        return bisect_right(self.times, time) - 1
+
+
+def parse_lyrics(payload: dict) -> Lyrics:
+    timed = []
+    for row in payload['lrc'].splitlines():
+        stamps = []
+        end = 0
+        while match := TAG.match(row, end):
+            stamps.append(round((int(match[1]) * 60 + float(match[2])) * 1000))
+            end = match.end()
+        # Rows without a time tag are metadata or credits
+        text = row[end:].strip()
+        timed.extend((stamp, text) for stamp in stamps)
+    timed.sort(key=lambda line: line[0])
+    return Lyrics([stamp for stamp, _ in timed], [text for _, text in timed])
+
+
+@cached('lyrics', parse=parse_lyrics)
+def get_lyrics(track_id: int) -> dict:
+    # Only the LRC text is kept, instrumental tracks have none
+    return {'lrc': apis.track.GetTrackLyrics(track_id).get('lrc', {}).get('lyric') or ''}
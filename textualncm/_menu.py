@@ -1,12 +1,41 @@
+from __future__ import annotations
 from pyncm import apis
-from functools import cache
+from concurrent.futures import ThreadPoolExecutor
+from _cache import cached, metacache
+from _library import library
+from _network import network
+from _likes import likes
 from _track import Track
+from _index import index
+from _worker import load
 from textual.widgets import Tree
 from textual.widgets.tree import TreeNode
 from textual.message import Message
 from textual.binding import Binding
 
 
+def strip_tracks(payload: list[dict]) -> list[dict]:
+    # Keep only the fields the client uses so that cached payloads stay small
+    return [{'name': tr['name'],
+             'id': tr['id'],
+             'ar': [{'id': ar['id'], 'name': ar['name']} for ar in tr['ar']],
+             'al': {'id': tr['al']['id'], 'name': tr['al']['name']}}
+            for tr in payload]
+
+
+def parse_tracks(payload: list[dict]) -> list[Track]:
+    tracks = []
+    for tr in payload:
+        name = tr['name']
+        track_id = tr['id']
+        artists = {ar['id']: ar['name'] for ar in tr['ar']}
+        album = tr['al']['name']
+        album_id = tr['al']['id']
+        tracks.append(Track(name, track_id, artists, album, album_id))
+    index.add(tracks)
+    return tracks
+
+
 class MenuNode(TreeNode):
     def __init__(self):  # noqa
         self.data = None
@@ -30,33 +59,42 @@ class MenuNode(TreeNode):
         # Abstract method: Requests track list from API for track table
         pass
 
-    def load(self) -> None:
-        self.has_more, data = self.request()
-        for item in data:
-            self.add_leaf(*item)
+    @classmethod
+    def stream_tracks(cls, entry_id: str):
+        # Requests track list for track table, either as a list or as an
+        # iterator of pages for entries which may be large
+        return cls.get_tracks(entry_id)
+
+    def load(self, then=None) -> None:
+        def fill(result):
+            self.has_more, data = result
+            for item in data:
+                self.add_leaf(*item)
+            if then:
+                then()
+        load(self._tree, f'menu-{self.id}', fill, self.request)
 
     def next(self) -> None:
         if not self.has_more:
             return
 
         self.page += 1
-        self.has_more, data = self.request(self.page)
-        if self.page >= 1:
-            for i in range(len(data)):
-                node = self.children[i]
-                node.set_label(data[i][0])
-                node.data = data[i][1]
+        load(self._tree, f'menu-{self.id}', self.relabel, self.request, self.page)
 
     def prev(self) -> None:
         if self.page == 0:
             return
 
         self.page -= 1
-        self.has_more, data = self.request(self.page)
+        load(self._tree, f'menu-{self.id}', self.relabel, self.request, self.page)
+
+    def relabel(self, result) -> None:
+        self.has_more, data = result
         for i in range(len(data)):
             node = self.children[i]
             node.set_label(data[i][0])
             node.data = data[i][1]
+        self._tree.refresh()
 
 
 class MenuTree(Tree):
@@ -74,19 +112,35 @@ class MenuTree(Tree):
 
     def on_mount(self):
         self.root.add_leaf('每日推荐歌曲')
-        self.add_menu(ArtistMenu()).load()
-        self.add_menu(AlbumMenu()).load()
-        self.add_menu(PlaylistMenu()).load()
-        self.action_select_cursor()
+        self.add_menu(ArtistMenu())
+        self.add_menu(AlbumMenu())
+        self.add_menu(PlaylistMenu())
+        self.root.add_leaf('本地音乐')
         self.focus()
 
+    def load_menus(self):
+        """Fill the menus and show the daily songs, called once the first frame is drawn"""
+        artists, albums, playlists = self.root.children[1:4]
+        artists.load()
+        albums.load()
+        playlists.load(then=self.find_likes)
+        load(self, 'likes', lambda _: self.post_message(self.Likes()), likes.load)
+        self.action_select_cursor()
+
+    def reconnect(self):
+        """Fill the menus that could not be loaded offline and reload the likes"""
+        artists, albums, playlists = self.root.children[1:4]
+        for menu in (artists, albums):
+            if not menu.children:
+                menu.load()
+        if not playlists.children:
+            playlists.load(then=self.find_likes)
+        load(self, 'likes', lambda _: self.post_message(self.Likes()), likes.load)
+
+    def find_likes(self):
+        # The first playlist of a user holds their liked tracks
         playlist_menu: MenuNode = self.root.children[3]
-        liked_node = playlist_menu.children[0]
-        liked = playlist_menu.get_tracks(liked_node.data)
-        for track in liked:
-            track.liked = True
-        message = self.Likes(liked)
-        self.post_message(message)
+        likes.playlist_id = playlist_menu.children[0].data
 
     def add_menu(self, node: MenuNode):
         node._tree = self
@@ -103,37 +157,39 @@ class MenuTree(Tree):
     def action_prev(self) -> None:
         if hasattr(self.cursor_node.parent, 'prev'):
             self.cursor_node.parent.prev()
-            self.refresh()
 
     def action_next(self) -> None:
         if hasattr(self.cursor_node.parent, 'next'):
             self.cursor_node.parent.next()
-            self.refresh()
 
     def action_select_cursor(self):
         super().action_select_cursor()
         cursor = self.cursor_node
         menu = cursor.parent
         if cursor.label.plain == '每日推荐歌曲':
-            tracks = get_daily_songs()
-            message = self.UpdateTable(tracks)
+            message = self.UpdateTable(get_daily_songs)
+            self.post_message(message)
+        elif cursor.label.plain == '本地音乐':
+            message = self.UpdateTable(get_local_tracks)
             self.post_message(message)
         elif cursor.data:
-            tracks = menu.get_tracks(cursor.data)
-            message = self.UpdateTable(tracks)
+            message = self.UpdateTable(menu.stream_tracks, cursor.data)
             self.post_message(message)
 
     class UpdateTable(Message):
-        """Update track table message"""
+        """Update track table message
 
-        def __init__(self, tracks: list):
-            self.tracks = tracks
+        Carries the function that fetches the tracks, so that the table can
+        request them off the event loop
+        """
+
+        def __init__(self, fetch, *args):
+            self.fetch = fetch
+            self.args = args
             super().__init__()
 
     class Likes(Message):
-        def __init__(self, tracks: list):
-            self.tracks = tracks
-            super().__init__()
+        """The ids of the liked tracks have been loaded"""
 
     def action_play(self):
         cursor: TreeNode = self.cursor_node
@@ -141,9 +197,8 @@ class MenuTree(Tree):
         if menu.data in ('next', 'prev'):
             return
         if cursor.data:
-            tracks = menu.get_tracks(cursor.data)
-            message = self.Play(tracks)
-            self.post_message(message)
+            load(self, 'play', lambda tracks: self.post_message(self.Play(tracks)),
+                 menu.get_tracks, cursor.data)
 
     class Play(Message):
         """Tell the app to play a playlist"""
@@ -158,9 +213,8 @@ class MenuTree(Tree):
         if menu.data in ('next', 'prev'):
             return
         if cursor.data:
-            tracks = menu.get_tracks(cursor.data)
-            message = self.Download(tracks)
-            self.post_message(message)
+            load(self, 'download', lambda tracks: self.post_message(self.Download(tracks)),
+                 menu.get_tracks, cursor.data)
 
     class Download(Message):
         """Tell the app to download a playlist"""
@@ -179,7 +233,7 @@ class ArtistMenu(MenuNode):
         self._label = '关注的艺人'
 
     @staticmethod
-    @cache
+    @cached('artist_menu')
     def request(page=0):
         offset = page * 9
         payload = apis.user.GetUserArtistSubs(9, offset)
@@ -188,18 +242,9 @@ class ArtistMenu(MenuNode):
         return has_more, data
 
     @staticmethod
-    @cache
+    @cached('artist', parse=parse_tracks)
     def get_tracks(artist_id: str):
-        payload = apis.user.GetArtistTopSongs(artist_id)['songs']
-        tracks = []
-        for tr in payload:
-            name = tr['name']
-            track_id = tr['id']
-            artists = {ar['id']: ar['name'] for ar in tr['ar']}
-            album = tr['al']['name']
-            album_id = tr['al']['id']
-            tracks.append(Track(name, track_id, artists, album, album_id))
-        return tracks
+        return strip_tracks(apis.user.GetArtistTopSongs(artist_id)['songs'])
 
 
 class AlbumMenu(MenuNode):
@@ -208,7 +253,7 @@ class AlbumMenu(MenuNode):
         self._label = '收藏的专辑'
 
     @staticmethod
-    @cache
+    @cached('album_menu')
     def request(page=0):
         offset = page * 9
         payload = apis.user.GetUserAlbumSubs(9, offset)
@@ -217,18 +262,9 @@ class AlbumMenu(MenuNode):
         return has_more, data
 
     @staticmethod
-    @cache
+    @cached('album', parse=parse_tracks)
     def get_tracks(album_id: str) -> list:
-        payload = apis.album.GetAlbumInfo(album_id)['songs']
-        tracks = []
-        for tr in payload:
-            name = tr['name']
-            track_id = tr['id']
-            artists = {ar['id']: ar['name'] for ar in tr['ar']}
-            album = tr['al']['name']
-            album_id = tr['al']['id']
-            tracks.append(Track(name, track_id, artists, album, album_id))
-        return tracks
+        return strip_tracks(apis.album.GetAlbumInfo(album_id)['songs'])
 
 
 class PlaylistMenu(MenuNode):
@@ -237,6 +273,7 @@ class PlaylistMenu(MenuNode):
         self._label = '创建的歌单'
 
     @staticmethod
+    @cached('playlist_menu')
     def request(page=0):
         payload = apis.user.GetUserPlaylists()['playlist']
         data = [(pl['name'], pl['id']) for pl in payload]
@@ -249,29 +286,80 @@ class PlaylistMenu(MenuNode):
         return
 
     @staticmethod
-    @cache
+    @cached('playlist', parse=parse_tracks)
     def get_tracks(playlist: str) -> list:
-        payload = apis.playlist.GetPlaylistInfo(playlist)['playlist']['tracks']
-        tracks = []
-        for tr in payload:
-            name = tr['name']
-            track_id = tr['id']
-            artists = {ar['id']: ar['name'] for ar in tr['ar']}
-            album = tr['al']['name']
-            album_id = tr['al']['id']
-            tracks.append(Track(name, track_id, artists, album, album_id))
-        return tracks
-
-
-@cache
-def get_daily_songs() -> list[Track]:
-    payload = apis.user.GetDailyRecommends()['data']['dailySongs']
-    tracks = []
-    for tr in payload:
-        name = tr['name']
-        track_id = tr['id']
-        artists = {ar['id']: ar['name'] for ar in tr['ar']}
-        album = tr['al']['name']
-        album_id = tr['al']['id']
-        tracks.append(Track(name, track_id, artists, album, album_id))
+        return [tr for page in iter_playlist(playlist) for tr in page]
+
+    @classmethod
+    def stream_tracks(cls, playlist: str):
+        if cls.get_tracks.is_cached(playlist):
+            # In pages as when fetched, the table shows the first ones sooner
+            tracks = cls.get_tracks(playlist)
+            for i in range(0, len(tracks), BATCH):
+                yield tracks[i:i + BATCH]
+            return
+
+        payload, tracks = [], []
+        for page in iter_playlist(playlist):
+            payload.extend(page)
+            page = parse_tracks(page)
+            tracks.extend(page)
+            yield page
+        cls.get_tracks.put(playlist, payload, tracks)
+
+
+# Number of tracks requested per GetTrackDetail call
+BATCH = 500
+batcher = ThreadPoolExecutor(max_workers=4)
+
+
+def get_track_details(track_ids: list[int]) -> list[dict]:
+    return apis.track.GetTrackDetail(track_ids)['songs']
+
+
+def iter_playlist(playlist: str):
+    """Yield the tracks of a playlist page by page, in playlist order
+
+    GetPlaylistInfo truncates 'tracks' for large playlists, so the remaining
+    entries of 'trackIds' are resolved in batches issued in parallel.
+    """
+    payload = apis.playlist.GetPlaylistInfo(playlist)['playlist']
+    first = strip_tracks(payload['tracks'])
+    yield first
+
+    loaded = {tr['id'] for tr in first}
+    rest = [tr['id'] for tr in payload['trackIds'] if tr['id'] not in loaded]
+    batches = [rest[i:i + BATCH] for i in range(0, len(rest), BATCH)]
+    futures = [batcher.submit(get_track_details, batch) for batch in batches]
+    try:
+        for future in futures:
+            yield strip_tracks(future.result())
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+@cached('daily', parse=parse_tracks)
+def get_daily_songs(_=0) -> list[Track]:
+    return strip_tracks(apis.user.GetDailyRecommends()['data']['dailySongs'])
+
+
+def get_local_tracks(_=0) -> list[Track]:
+    """Downloaded tracks, described by the metadata stored when they were downloaded"""
+    ids = library.ids()
+    payloads = metacache.get_many('track', ids)
+    missing = [track_id for track_id in ids if str(track_id) not in payloads]
+    if missing and network.online:
+        # Downloaded before their metadata was stored
+        try:
+            for i in range(0, len(missing), BATCH):
+                found = {song['id']: song for song in strip_tracks(get_track_details(missing[i:i + BATCH]))}
+                metacache.put_many('track', found)
+                payloads.update((str(track_id), song) for track_id, song in found.items())
+        except Exception as exc:
+            if not network.check(exc):
+                raise
+    tracks = parse_tracks([payloads[str(track_id)] for track_id in ids if str(track_id) in payloads])
+    tracks.extend(Track(str(track_id), track_id, {}, '', 0)
+                  for track_id in ids if str(track_id) not in payloads)
     return tracks
@@ -0,0 +1,75 @@
+from __future__ import annotations
+import socket
+import time
+from requests import ConnectionError, Timeout
+from threading import Lock, Thread
+
+# Probed to tell whether the API can be reached
+API = ('music.163.com', 443)
+# Seconds between probes while offline
+PROBE = 15
+TIMEOUT = 3
+
+
+class Offline(Exception):
+    """Raised instead of sending a request while the API cannot be reached"""
+
+
+class Network:
+    """Whether the API can be reached
+
+    A request failing to connect switches to offline. While offline the API
+    host is probed in the background, and listeners are called with the new
+    state, from that thread, whenever it changes.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.online = True
+        self.listeners = []
+
+    def subscribe(self, listener) -> None:
+        self.listeners.append(listener)
+
+    def start(self) -> None:
+        """Probe the API once in the background, so that an offline start fails fast"""
+        Thread(target=lambda: self.reachable() or self.set(False), daemon=True).start()
+
+    def require(self) -> None:
+        if not self.online:
+            raise Offline
+
+    def check(self, exc: BaseException | None) -> bool:
+        """Go offline if exc is a failure to reach the API, returning whether it is"""
+        if isinstance(exc, Offline):
+            return True
+        if isinstance(exc, (ConnectionError, Timeout)):
+            self.set(False)
+            return True
+        return False
+
+    def set(self, online: bool) -> None:
+        with self.lock:
+            if online == self.online:
+                return
+            self.online = online
+            if not online:
+                Thread(target=self.probe, daemon=True).start()
+        for listener in self.listeners:
+            listener(online)
+
+    @staticmethod
+    def reachable() -> bool:
+        try:
+            socket.create_connection(API, timeout=TIMEOUT).close()
+            return True
+        except OSError:
+            return False
+
+    def probe(self) -> None:
+        while not self.reachable():
+            time.sleep(PROBE)
+        self.set(True)
+
+
+network = Network()
@@ -1,21 +1,66 @@
-from vlc import MediaPlayer, Media, EventManager, EventType
+from __future__ import annotations
+import asyncio
 from _track import Track
+from _playqueue import Queue
 from datetime import timedelta
-from random import randint
+from functools import cached_property, partial
+from time import perf_counter
+from collections import deque
+from urllib.request import urlopen
+from textual.app import ComposeResult
 from textual.widget import Widget
+from textual.widgets import Static
 from textual.reactive import reactive
 from textual.message import Message
 from rich.progress import Progress, BarColumn, TextColumn
-from rich.console import group
+from rich.console import Group
 from rich.text import Text
 from rich.columns import Columns
 from rich.padding import Padding
 from pyncm import apis
+from _worker import load, executor
+from _resolver import resolver
+from _streaming import url as proxy_url
+from _audiocache import audiocache
+from _library import library
+from _network import network
+from _lyrics import Lyrics, get_lyrics
+
+# Number of upcoming tracks to prepare while the current one plays
+PREFETCH = 2
+# Leading bytes of each upcoming track pulled into the audio cache
+PREBUFFER = 512 * 2 ** 10
+
+
+def prebuffer(track_id: int) -> None:
+    # Reading through the proxy writes the start of the track to its part file
+    try:
+        with urlopen(proxy_url(track_id)) as response:
+            response.read(PREBUFFER)
+    except OSError:
+        pass
+
+
+class Clock(Widget):
+    """Elapsed time and progress bar, the only part repainted while a track plays"""
+
+    def render(self):
+        return Player.progress
+
+
+class Lyric(Widget):
+    """The line of the lyrics being sung and the next one, repainted when the line changes"""
+
+    def render(self):
+        player: Player = self.parent
+        lyrics, line = player.lyrics, player.line
+        current = lyrics.lines[line] if line >= 0 else ''
+        following = lyrics.lines[line + 1] if line + 1 < len(lyrics) else ''
+        return Group(Text(current, style='bold', justify='center'),
+                     Text(following, style='dim', justify='center'))
 
 
 class Player(Widget):
-    player: MediaPlayer = MediaPlayer()
-    manager: EventManager = player.event_manager()
     track: Track = Track.EmptyTrack()
     progress = Progress(TextColumn('{task.fields[elapsed]}'),
                         BarColumn(bar_width=None),
@@ -24,23 +69,51 @@ class Player(Widget):
                         expand=True)
     bar = progress.add_task('', total=None, elapsed='0:00', length='0:00')
 
-    time: int = reactive(0)
-    is_playing: bool = reactive(False)
-    mode: str = reactive('loop')
+    time: int = reactive(0, repaint=False)
+    is_playing: bool = reactive(False, repaint=False)
+    mode: str = reactive('loop', repaint=False)
 
-    playlist: list = []
-    index: int = 0
+    def compose(self) -> ComposeResult:
+        self.clock = Clock()
+        self.lyric = Lyric(id='lyric')
+        yield Static(id='title')
+        yield self.lyric
+        yield self.clock
+        yield Static(id='controls')
 
     def on_mount(self):
-        self.set_interval(0.9, self.update_time)
-        self.manager.event_attach(EventType.MediaPlayerEndReached, self.end_reached)
+        self.queue = Queue()
+        self.media: dict = {}
+        self.ended: float = 0
+        self.gaps: deque[float] = deque(maxlen=100)
+        self.shown: tuple | None = None
+        self.lyrics = Lyrics([], [])
+        self.line = -1
+        self.show_track()
 
-    def render(self):
-        return self.renderable
+    @cached_property
+    def player(self):
+        # libvlc takes a while to load, so it is only imported on first use
+        import vlc
+        self.loop = asyncio.get_running_loop()
+        player = vlc.MediaPlayer()
+        manager = player.event_manager()
+        manager.event_attach(vlc.EventType.MediaPlayerEndReached, self.end_reached)
+        manager.event_attach(vlc.EventType.MediaPlayerPlaying, self.playing)
+        manager.event_attach(vlc.EventType.MediaPlayerTimeChanged, self.time_changed)
+        return player
+
+    @staticmethod
+    def new_media(track: Track):
+        from vlc import Media
+        return Media(Player.url(track))
+
+    def show_track(self) -> None:
+        """Redraw the title and controls, after the track or one of its states changed"""
+        self.query_one('#title', Static).update(Group(
+            Text(self.track.name, justify='center'),
+            Text(self.track.artists, justify='center')))
 
-    @property
-    @group()
-    def renderable(self):
         last = "⏮ [ 上一首"
         play = "⏯ [ 空格]暂停" if self.is_playing else "⏯ [ 空格]播放"
         _next = "⏭ ] 下一首"
@@ -57,24 +130,89 @@ class Player(Widget):
         playlist = '[G]播放列表'
         lower = (like, download, playlist)
 
-        yield Text(self.track.name, justify='center')
-        yield Text(self.track.artists, justify='center')
-        yield self.progress
-        yield Padding(Columns(upper, expand=True), 1)
-        yield Columns(lower, expand=True)
+        self.query_one('#controls', Static).update(Group(
+            Padding(Columns(upper, expand=True), 1),
+            Columns(lower, expand=True)))
 
     def play(self, track: Track):
         self.player.stop()
         self.track = track
-        if track.local:
-            url = f'downloads/{track.id}.mp3'
-        else:
-            track.length = apis.track.GetTrackDetail([track.id])['songs'][0]['dt']
-            url = f'http://127.0.0.1:5000/track/{track.id}'
-        media = Media(url)
+        media = self.media.pop(track.id, None)
+        if media is None or not network.online:
+            # Media prepared online may point at the proxy
+            media = self.new_media(track)
         self.player.set_media(media)
         self.player.play()
         self.is_playing = True
+        self.shown = None
+        self.time = 0
+        self.show_track()
+        self.lyrics = Lyrics([], [])
+        self.line = -1
+        self.lyric.refresh()
+        load(self.lyric, 'lyrics', partial(self.set_lyrics, track), get_lyrics, track.id)
+        self.prefetch()
+
+    def set_lyrics(self, track: Track, lyrics: Lyrics) -> None:
+        if track is self.track:
+            self.lyrics = lyrics
+            self.shown = None
+            self.line = lyrics.index(self.time)
+            self.lyric.refresh()
+
+    @staticmethod
+    def url(track: Track) -> str:
+        if track.local:
+            return str(library.file(track.id))
+        # Offline, tracks streamed whole before play from the audio cache
+        if not network.online and (path := audiocache.get(track.id)):
+            return str(path)
+        return proxy_url(track.id)
+
+    @staticmethod
+    def playable(track: Track) -> bool:
+        return network.online or track.local or track.id in audiocache.entries
+
+    def upcoming(self) -> list[Track]:
+        """The tracks that will be played after the current one"""
+        if not self.queue:
+            return []
+        if self.mode == 'single':
+            return [self.track]
+        return self.queue.peek(PREFETCH)
+
+    def prefetch(self) -> None:
+        """Resolve, pre-buffer and create media for the upcoming tracks
+
+        Switching to a prepared track then only has to hand VLC a media whose
+        first bytes are already on disk.
+        """
+        upcoming = [track for track in self.upcoming() if track is not self.track]
+        self.media = {track.id: self.media.get(track.id) or self.new_media(track)
+                      for track in upcoming}
+        remote = [track for track in upcoming if not track.local and network.online]
+        resolver.prefetch(track.id for track in remote)
+        for track in remote:
+            executor.submit(prebuffer, track.id)
+        if network.online:
+            for track in upcoming:
+                executor.submit(get_lyrics, track.id)
+
+        missing = [track for track in [self.track, *remote] if not track.local and not track.length]
+        if missing and network.online:
+            load(self, 'detail', self.set_lengths, self.get_lengths, missing)
+
+    @staticmethod
+    def get_lengths(tracks: list[Track]) -> list[tuple[Track, int]]:
+        songs = apis.track.GetTrackDetail([track.id for track in tracks])['songs']
+        lengths = {song['id']: song['dt'] for song in songs}
+        return [(track, lengths.get(track.id, 0)) for track in tracks]
+
+    def set_lengths(self, result: list[tuple[Track, int]]) -> None:
+        for track, length in result:
+            track.length = length
+        if any(track is self.track for track, _ in result):
+            self.watch_time(self.time)
 
     def pause(self):
         if self.player.is_playing():
@@ -84,33 +222,49 @@ class Player(Widget):
             self.player.play()
             self.is_playing = True
 
-    def set_playlist(self, playlist: list[Track]):
-        self.playlist = playlist
-        self.index = playlist.index(self.track)
+    def play_from(self, playlist: list[Track], track: Track):
+        # Playing from the list already queued keeps its history and shuffled
+        # order. The queue is loaded first, so that the tracks prepared are
+        # the ones after track
+        self.queue.load(playlist)
+        self.queue.jump(track)
+        self.play(track)
 
     def play_playlist(self, playlist: list[Track]):
-        self.playlist = playlist
-        if self.mode == 'shuffle':
-            self.index = randint(0, len(self.playlist))
-        else:
-            self.index = 0
-        track = self.playlist[self.index]
-        self.play(track)
+        self.queue.load(playlist)
+        if track := self.queue.first():
+            if self.playable(track):
+                self.play(track)
+            else:
+                self.next()
 
     def prev(self):
-        if self.playlist:
-            self.index = (self.index - 1) % len(self.playlist)
-            track = self.playlist[self.index]
-            self.play(track)
+        self.advance(self.queue.prev)
 
     def next(self):
-        if self.playlist:
-            if self.mode == 'shuffle':
-                self.index = randint(0, len(self.playlist))
-            else:
-                self.index = (self.index + 1) % len(self.playlist)
-            track = self.playlist[self.index]
-            self.play(track)
+        self.advance(self.queue.next)
+
+    def advance(self, move) -> None:
+        # Offline, tracks that are neither downloaded nor cached are skipped
+        for _ in range(len(self.queue)):
+            track = move()
+            if track is None:
+                return
+            if self.playable(track):
+                self.play(track)
+                return
+
+    def enqueue(self, track: Track):
+        self.queue.enqueue(track)
+        self.prefetch()
+
+    def play_next(self, track: Track):
+        self.queue.play_next(track)
+        self.prefetch()
+
+    def dequeue(self, track: Track):
+        self.queue.remove(track)
+        self.prefetch()
 
     def toggle_mode(self):
         if self.mode == 'loop':
@@ -120,24 +274,73 @@ class Player(Widget):
         elif self.mode == 'shuffle':
             self.mode = 'loop'
 
-    def update_time(self) -> None:
-        if self.player.is_playing():
-            self.time = self.player.get_time()
+    def watch_mode(self, mode: str):
+        self.queue.set_shuffle(mode == 'shuffle')
+        self.show_track()
+        self.prefetch()
+
+    def watch_is_playing(self, is_playing: bool):
+        _ = is_playing
+        self.show_track()
+
+    def time_changed(self, event):
+        # Called from a VLC thread several times a second, only times the
+        # clock would draw differently or that start a new line of the lyrics
+        # are passed on to the event loop
+        time = event.u.new_time
+        shown = self.draws(time), self.lyrics.index(time)
+        if shown != self.shown:
+            self.shown = shown
+            self.loop.call_soon_threadsafe(setattr, self, 'time', time)
+
+    def draws(self, time: int) -> tuple[int, int]:
+        """The elapsed seconds and the half cells of the bar the clock shows at time"""
+        # Both times take five cells and are separated from the bar by a space
+        cells = max(self.clock.size.width - 12, 1) * 2
+        length = self.track.length
+        return round(time / 1000), time * cells // length if length > 0 else 0
 
     def watch_time(self, time: int):
         track = self.track
-        with self.progress as progress:
-            elapsed = str(timedelta(seconds=round(time / 1000)))[2:]
-            if track.local and not track.length:
-                track.length = self.player.get_length()
-            length = str(timedelta(seconds=round(track.length / 1000)))[2:]
-            progress.update(self.bar, elapsed=elapsed, length=length, total=track.length, completed=time)
+        elapsed = str(timedelta(seconds=round(time / 1000)))[2:]
+        if track.local and not track.length:
+            track.length = self.player.get_length()
+        length = str(timedelta(seconds=round(track.length / 1000)))[2:]
+        # The progress is only rendered by the clock, it is never started:
+        # starting and stopping it printed it to the terminal on every tick
+        self.progress.update(self.bar, elapsed=elapsed, length=length, total=track.length, completed=time)
+        self.clock.refresh()
+        line = self.lyrics.index(time)
+        if line != self.line:
+            self.line = line
+            self.lyric.refresh()
 
     def end_reached(self, event):
         _ = event
+        self.ended = perf_counter()
         message = self.EndReached()
         self.post_message(message)
 
+    def playing(self, event):
+        _ = event
+        if self.ended:
+            gap = perf_counter() - self.ended
+            self.ended = 0
+            message = self.Started(gap)
+            self.post_message(message)
+
+    class Started(Message):
+        """Playback has started after the previous track ended"""
+
+        def __init__(self, gap: float):
+            self.gap = gap
+            super().__init__()
+
+    def on_player_started(self, message: Started):
+        # Time between the end of a track and the first audio of the next
+        self.gaps.append(message.gap)
+        self.log(f'track gap: {message.gap * 1000:.0f} ms')
+
     class EndReached(Message):
         """The media player has reached the end of the current track"""
 
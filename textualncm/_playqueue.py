@@ -0,0 +1,277 @@
+from __future__ import annotations
+import random
+from collections import deque
+from itertools import chain
+from _track import Track
+
+# Tracks played kept to walk back through
+HISTORY = 1000
+
+
+class Queue:
+    """Tracks to play, in their order or shuffled, with a history of those played
+
+    Tracks are found by id in constant time. Removed tracks leave a hole
+    that is skipped, and the holes are compacted once they make up half of
+    the queue. The shuffled order is a permutation drawn once, tracks added
+    later are swapped into a random place of its unplayed part. Tracks put
+    up next are played before either order, which then goes on from the
+    track played before them. Going back walks the history, and going
+    forward again replays it before drawing new tracks.
+    """
+
+    def __init__(self):
+        # The list the queue was loaded from, tracks appended to it since are
+        # picked up on the next load
+        self.source: list[Track] | None = None
+        self.loaded = 0
+        # The list last returned by listing(), until the queue changes
+        self.listed: list[Track] | None = None
+        self.tracks: list[Track | None] = []
+        self.positions: dict[int, int] = {}
+        self.holes = 0
+        # Position of the current track, kept when it is removed
+        self.position = -1
+        self.upnext: deque[int] = deque()
+        self.shuffle = False
+        self.order: list[int] = []
+        self.slots: dict[int, int] = {}
+        # Index in order of the last track drawn from it
+        self.cursor = -1
+        self.history: list[int] = []
+        # Position the queue goes on from after each track of the history
+        self.spots: list[int] = []
+        self.at = -1
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, track: Track) -> bool:
+        return track.id in self.positions
+
+    @property
+    def current(self) -> Track | None:
+        if 0 <= self.at < len(self.history):
+            return self.get(self.history[self.at])
+        return None
+
+    def get(self, track_id: int) -> Track | None:
+        position = self.positions.get(track_id)
+        return None if position is None else self.tracks[position]
+
+    def load(self, tracks: list[Track]) -> None:
+        """Play from tracks, keeping the history if they are the list already loaded"""
+        if tracks is self.listed:
+            return
+        if tracks is self.source:
+            # Tables only ever append to the list they show
+            for track in tracks[self.loaded:]:
+                self.enqueue(track)
+            self.loaded = len(tracks)
+            return
+        shuffle = self.shuffle
+        self.__init__()
+        for track in tracks:
+            self.enqueue(track)
+        self.source = tracks
+        self.loaded = len(tracks)
+        self.set_shuffle(shuffle)
+
+    def listing(self) -> list[Track]:
+        """The tracks of the queue in their order"""
+        if self.listed is None:
+            if self.source is not None and not self.holes and len(self.tracks) == self.loaded:
+                self.listed = self.source
+            else:
+                self.listed = [track for track in self.tracks if track is not None]
+        return self.listed
+
+    def index(self, track: Track) -> int | None:
+        """The row of a track in listing(), None if it is not queued"""
+        if self.holes:
+            self.compact()
+        return self.positions.get(track.id)
+
+    def enqueue(self, track: Track) -> None:
+        """Add a track at the end of the queue, and at a random place of the unplayed shuffled tracks"""
+        if track.id in self.positions:
+            return
+        self.listed = None
+        self.positions[track.id] = len(self.tracks)
+        self.tracks.append(track)
+        if self.order:
+            self.slots[track.id] = len(self.order)
+            self.order.append(track.id)
+            self.swap(len(self.order) - 1, random.randint(self.cursor + 1, len(self.order) - 1))
+
+    def play_next(self, track: Track) -> None:
+        """Play a track after the current one, before those put up next earlier"""
+        self.enqueue(track)
+        self.upnext.appendleft(track.id)
+
+    def remove(self, track: Track) -> None:
+        position = self.positions.pop(track.id, None)
+        if position is None:
+            return
+        self.listed = None
+        self.tracks[position] = None
+        self.holes += 1
+        # The shuffled order, history and tracks up next skip removed ids
+        if self.holes * 2 > len(self.tracks):
+            self.compact()
+
+    def compact(self) -> None:
+        kept = [0]
+        for track in self.tracks:
+            kept.append(kept[-1] + (track is not None))
+
+        def moved(position: int) -> int:
+            if position < 0:
+                return position
+            # A removed track still counts as the one before the next
+            return kept[position] - (self.tracks[position] is None)
+
+        self.position = moved(self.position)
+        self.spots = [moved(spot) for spot in self.spots]
+        self.tracks = [track for track in self.tracks if track is not None]
+        self.positions = {track.id: i for i, track in enumerate(self.tracks)}
+        self.holes = 0
+        if self.order:
+            played = [i for i in self.order[:self.cursor + 1] if i in self.positions]
+            unplayed = [i for i in self.order[self.cursor + 1:] if i in self.positions]
+            self.order = played + unplayed
+            self.slots = {track_id: i for i, track_id in enumerate(self.order)}
+            self.cursor = len(played) - 1
+
+    def set_shuffle(self, shuffle: bool) -> None:
+        self.shuffle = shuffle
+        if not shuffle:
+            self.order, self.slots, self.cursor = [], {}, -1
+            return
+        self.draw()
+        if current := self.current:
+            self.swap(0, self.slots[current.id])
+            self.cursor = 0
+
+    def draw(self) -> None:
+        """Draw a new shuffled order"""
+        self.order = [track.id for track in self.tracks if track is not None]
+        random.shuffle(self.order)
+        self.slots = {track_id: i for i, track_id in enumerate(self.order)}
+        self.cursor = -1
+
+    def swap(self, i: int, j: int) -> None:
+        order = self.order
+        order[i], order[j] = order[j], order[i]
+        self.slots[order[i]] = i
+        self.slots[order[j]] = j
+
+    def first(self) -> Track | None:
+        """Start the queue over and return its first track"""
+        self.history, self.spots, self.at = [], [], -1
+        self.position = -1
+        self.upnext.clear()
+        if self.shuffle and self.cursor >= 0:
+            self.draw()
+        return self.next()
+
+    def jump(self, track: Track) -> None:
+        """Make a track of the queue the current one"""
+        if track.id not in self.positions or track is self.current:
+            return
+        self.push(track.id)
+
+    def push(self, track_id: int, upnext: bool = False) -> None:
+        if self.order and self.slots[track_id] > self.cursor:
+            # Played now, it is not drawn again in this round
+            self.cursor += 1
+            self.swap(self.cursor, self.slots[track_id])
+        # Jumping after going back drops the tracks ahead
+        del self.history[self.at + 1:]
+        del self.spots[self.at + 1:]
+        # Tracks up next leave the queue where it was
+        if not upnext:
+            self.position = self.positions[track_id]
+        self.history.append(track_id)
+        self.spots.append(self.position)
+        if len(self.history) > HISTORY:
+            del self.history[:len(self.history) - HISTORY]
+            del self.spots[:len(self.spots) - HISTORY]
+        self.at = len(self.history) - 1
+
+    def upcoming(self):
+        """Where the tracks after the current one come from, as (source, index, id)
+
+        The tracks ahead in the history come first, then those up next, then
+        the next ones of the shuffled order or of the queue.
+        """
+        for i in range(self.at + 1, len(self.history)):
+            yield 'history', i, self.history[i]
+        for i, track_id in enumerate(self.upnext):
+            yield 'upnext', i, track_id
+        if self.shuffle:
+            # Wrapping around means drawing a new order, shown here as the
+            # current one played again
+            for i in chain(range(self.cursor + 1, len(self.order)), range(self.cursor + 1)):
+                yield 'order', i, self.order[i]
+        else:
+            size = len(self.tracks)
+            for i in range(self.position + 1, self.position + size + 1):
+                if track := self.tracks[i % size]:
+                    yield 'sequence', i % size, track.id
+
+    def peek(self, count: int) -> list[Track]:
+        """The next count tracks, without moving through the queue"""
+        found = []
+        for _, _, track_id in self.upcoming():
+            if len(found) == count:
+                break
+            if track := self.get(track_id):
+                found.append(track)
+        return found
+
+    def next(self) -> Track | None:
+        """Move to the track after the current one and return it"""
+        for source, i, track_id in self.upcoming():
+            if track_id not in self.positions:
+                continue
+            if source == 'history':
+                self.at = i
+                self.position = self.spots[i]
+            elif source == 'upnext':
+                for _ in range(i + 1):
+                    self.upnext.popleft()
+                self.push(track_id, upnext=True)
+            elif source == 'order':
+                if i <= self.cursor:
+                    current = self.current
+                    self.draw()
+                    if current and self.order[0] == current.id and len(self.order) > 1:
+                        # A new round does not start with the track that ended the last
+                        self.swap(0, len(self.order) - 1)
+                    i, track_id = 0, self.order[0]
+                self.cursor = i - 1
+                self.push(track_id)
+            else:
+                self.push(track_id)
+            return self.current
+        return None
+
+    def prev(self) -> Track | None:
+        """Move back to the track played before the current one and return it"""
+        for i in range(self.at - 1, -1, -1):
+            if self.history[i] in self.positions:
+                self.at = i
+                self.position = self.spots[i]
+                return self.current
+        if not self.shuffle and self.tracks:
+            # Nothing played before, the queue is walked backwards
+            size = len(self.tracks)
+            for i in range(self.position - 1, self.position - size - 1, -1):
+                if track := self.tracks[i % size]:
+                    self.history.insert(0, track.id)
+                    self.spots.insert(0, i % size)
+                    self.at = 0
+                    self.position = i % size
+                    return track
+        return None
@@ -1,22 +1,154 @@
-import logging
-from pyncm import apis, GetCurrentSession
-from flask import Flask
+from __future__ import annotations
+import re
+import time
+import asyncio
+from aiohttp import web, ClientSession, TCPConnector
+from _audiocache import audiocache
+from _resolver import resolver
+from _streaming import HOST, PORT, streaming
+from _trace import tracer
 
-app = Flask(__name__)
+CHUNK = 128 * 2 ** 10
 
-log = logging.getLogger('werkzeug')
-log.setLevel(logging.ERROR)
-app.logger.disabled = True
-log.disabled = True
 
+def parse_range(header: str | None) -> tuple[int, int | None] | None:
+    """Parse a single 'bytes=start-[end]' range, None if absent or unsupported"""
+    if not header:
+        return None
+    match = re.fullmatch(r'bytes=(\d+)-(\d*)', header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    return int(start), int(end) if end else None
 
-@app.route('/track/<int:track_id>')
-def stream_track(track_id):
-    audio = apis.track.GetTrackAudioV1([track_id], level='exhigh')
-    audio = audio.get("data", [{"url": ""}])[0]
-    response = GetCurrentSession().get(audio['url'], stream=True)
 
-    def stream():
-        for chunk in response.iter_content(128 * 2 ** 10):
-            yield chunk
-    return stream(), response.status_code
+async def resolve(track_id: int, fresh: bool = False) -> dict:
+    return await asyncio.wrap_future(resolver.submit(track_id, fresh))
+
+
+async def stream_track(request: web.Request) -> web.StreamResponse:
+    with tracer.span('stream', 'proxy') as event:
+        response = await serve_track(request, event)
+        if response.status >= 400:
+            event['error'] = f'status {response.status}'
+        return response
+
+
+async def serve_track(request: web.Request, event: dict) -> web.StreamResponse:
+    began = time.perf_counter()
+    track_id = int(request.match_info['track_id'])
+    if path := audiocache.get(track_id):
+        # Traced apart, cached tracks do not wait on the network and are sent
+        # once the handler has returned, so only the lookup is timed
+        event['name'] = 'stream cached'
+        event['bytes'] = path.stat().st_size
+        return web.FileResponse(path, chunk_size=CHUNK, headers={'Content-Type': 'audio/mpeg'})
+
+    audio = await resolve(track_id)
+    byte_range = parse_range(request.headers.get('Range'))
+    start, end = byte_range or (0, None)
+
+    # Serve bytes already held in the part file from disk and only fetch the
+    # remainder, writing it through to the cache
+    prefix = audiocache.prefix(track_id) if end is None else 0
+    local = prefix - start if start < prefix else 0
+    offset = start + local
+    headers = {'Range': f'bytes={offset}-{"" if end is None else end}'} if offset or end else {}
+
+    session: ClientSession = request.app['session']
+    upstream = await session.get(audio['url'], headers=headers)
+    if upstream.status in (403, 404):
+        # The signed URL has expired since it was resolved
+        upstream.release()
+        audio = await resolve(track_id, fresh=True)
+        upstream = await session.get(audio['url'], headers=headers)
+    async with upstream:
+        if upstream.status not in (200, 206):
+            return web.Response(status=upstream.status)
+        skip = 0
+        if headers and upstream.status == 200:
+            # The server ignored the range and sends the whole track, which
+            # starts the part file over
+            skip, local, offset = start, 0, 0
+
+        total = audio.get('size') or (upstream.content_length or 0) + offset
+        last = total - 1 if end is None else end
+        response = web.StreamResponse(status=206 if byte_range else 200)
+        response.content_type = 'audio/mpeg'
+        response.content_length = last - start + 1
+        response.headers['Accept-Ranges'] = 'bytes'
+        if byte_range:
+            response.headers['Content-Range'] = f'bytes {start}-{last}/{total}'
+        await response.prepare(request)
+
+        writer = audiocache.writer(track_id, offset, total) if end is None else None
+        remaining = last - start + 1 - local
+        streaming[track_id] += 1
+        try:
+            if local:
+                with open(audiocache.part(track_id), 'rb') as fp:
+                    fp.seek(start)
+                    remaining = local
+                    while remaining > 0:
+                        chunk = fp.read(min(CHUNK, remaining))
+                        remaining -= len(chunk)
+                        await response.write(chunk)
+                        event['bytes'] += len(chunk)
+            # write() waits for the socket to drain, so a slow player slows
+            # down the upstream read instead of buffering the whole track
+            async for chunk in upstream.content.iter_chunked(CHUNK):
+                if writer:
+                    writer.write(chunk)
+                if skip:
+                    skipped = min(skip, len(chunk))
+                    chunk, skip = chunk[skipped:], skip - skipped
+                chunk = chunk[:remaining]
+                if not chunk:
+                    # Still skipping, or filling the cache past the range sent
+                    if skip or writer:
+                        continue
+                    break
+                remaining -= len(chunk)
+                if 'upstream_first_byte_ms' not in event:
+                    event['upstream_first_byte_ms'] = (time.perf_counter() - began) * 1000
+                await response.write(chunk)
+                event['bytes'] += len(chunk)
+        finally:
+            streaming[track_id] -= 1
+            if not streaming[track_id]:
+                del streaming[track_id]
+            if writer:
+                writer.close()
+        await response.write_eof()
+        return response
+
+
+async def client_session(app: web.Application):
+    # Pooled upstream connections shared by every stream
+    connector = TCPConnector(limit=16, limit_per_host=8, keepalive_timeout=60)
+    async with ClientSession(connector=connector) as session:
+        app['session'] = session
+        yield
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get(r'/track/{track_id:\d+}', stream_track)
+    app.cleanup_ctx.append(client_session)
+    return app
+
+
+async def serve(host: str = HOST, port: int = PORT) -> None:
+    runner = web.AppRunner(create_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def run() -> None:
+    """Run the streaming server, blocking the calling thread"""
+    asyncio.run(serve())
@@ -0,0 +1,101 @@
+from __future__ import annotations
+import time
+from collections import OrderedDict
+from itertools import islice
+from pyncm import apis
+from threading import Lock, Timer
+from concurrent.futures import Future
+from _network import network
+
+# Seconds to wait for more ids before sending a batch
+WINDOW = 0.05
+# Most ids sent in one GetTrackAudioV1 call
+BATCH = 200
+# Signed URLs are renewed this many seconds before they expire
+MARGIN = 30
+# Most URLs kept, the least recently used are dropped first
+CAPACITY = 1000
+
+
+class Resolver:
+    """Resolves audio URLs in batches and keeps them until they expire
+
+    Ids requested within a short window are sent in a single GetTrackAudioV1
+    call. Callers get a Future for the audio entry of their track. At most
+    CAPACITY URLs are kept, expired ones are dropped first.
+    """
+
+    def __init__(self, level: str = 'exhigh'):
+        self.level = level
+        self.lock = Lock()
+        self.cache: OrderedDict[int, tuple[dict, float]] = OrderedDict()
+        self.pending: dict[int, Future] = {}
+        self.timer: Timer | None = None
+
+    def submit(self, track_id: int, fresh: bool = False) -> Future:
+        with self.lock:
+            hit = self.cache.get(track_id)
+            if hit and not fresh and hit[1] > time.time() + MARGIN:
+                self.cache.move_to_end(track_id)
+                future = Future()
+                future.set_result(hit[0])
+                return future
+            if track_id in self.pending:
+                return self.pending[track_id]
+            future = self.pending[track_id] = Future()
+            if self.timer is None:
+                self.timer = Timer(WINDOW, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+            return future
+
+    def resolve(self, track_id: int, fresh: bool = False) -> dict:
+        """Return the audio entry of a track, fetching a new URL if fresh is set"""
+        return self.submit(track_id, fresh).result()
+
+    def prefetch(self, track_ids) -> None:
+        # Those past CAPACITY would be dropped before they are used
+        for track_id in islice(track_ids, CAPACITY):
+            self.submit(track_id)
+
+    def invalidate(self, track_id: int) -> None:
+        with self.lock:
+            self.cache.pop(track_id, None)
+
+    def flush(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.timer = None
+
+        ids = list(pending)
+        for i in range(0, len(ids), BATCH):
+            batch = ids[i:i + BATCH]
+            try:
+                network.require()
+                data = apis.track.GetTrackAudioV1(batch, level=self.level).get('data', [])
+            except Exception as exc:
+                network.check(exc)
+                for track_id in batch:
+                    pending[track_id].set_exception(exc)
+                continue
+
+            now = time.time()
+            entries = {audio['id']: audio for audio in data}
+            with self.lock:
+                for track_id, audio in entries.items():
+                    if audio.get('url'):
+                        self.cache[track_id] = audio, now + audio.get('expi', 1200)
+                        self.cache.move_to_end(track_id)
+                self.evict(now)
+            for track_id in batch:
+                pending[track_id].set_result(entries.get(track_id, {'id': track_id, 'url': ''}))
+
+    def evict(self, now: float) -> None:
+        # Called with the lock held
+        for track_id in [track_id for track_id, (_, expires) in self.cache.items() if expires <= now + MARGIN]:
+            del self.cache[track_id]
+        while len(self.cache) > CAPACITY:
+            self.cache.popitem(last=False)
+
+
+resolver = Resolver()
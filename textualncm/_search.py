@@ -1,18 +1,46 @@
+from __future__ import annotations
+import asyncio
 from _track import Track
+from _index import index
 from datetime import date
-from pyncm.apis.cloudsearch import GetSearchResult
+from functools import lru_cache
+from itertools import count
+from pyncm import apis
 from textual.widgets import Input
 from textual.binding import Binding
 from textual.message import Message
+from _worker import call, spawn
+from _network import network
 
 SONG = 1         # 单曲
 ALBUM = 10       # 专辑
 ARTIST = 100     # 创作者
 PLAYLIST = 1000  # 歌单
+LIBRARY = -1     # 所有看过的曲目，无需联网
+FILTER = -2      # 当前列表
+
+# Key of a result of each mode in its table
+KEYS = {ALBUM: 'album_id', ARTIST: 'id', PLAYLIST: 'playlist_id'}
+
+PAGE = 50
+# Seconds without typing before searching
+DEBOUNCE = 0.3
+# Result pages kept in memory
+CACHE_SIZE = 256
+
+MODES = {
+    SONG: '搜索单曲',
+    ALBUM: '搜索专辑',
+    ARTIST: '搜索创作者',
+    PLAYLIST: '搜索歌单',
+    LIBRARY: '搜索曲库',
+    FILTER: '筛选当前列表'
+}
 
 
 class Search(Input):
     mode = SONG
+    pending: asyncio.Task | None = None
 
     BINDINGS = [
         Binding('up', 'prev_mode', 'Search Type', show=False),
@@ -20,74 +48,123 @@ class Search(Input):
     ]
 
     def action_next_mode(self) -> None:
-        if self.mode == SONG:
-            self.mode = ALBUM
-            self.placeholder = '搜索专辑'
-        elif self.mode == ALBUM:
-            self.mode = ARTIST
-            self.placeholder = '搜索创作者'
-        elif self.mode == ARTIST:
-            self.mode = PLAYLIST
-            self.placeholder = '搜索歌单'
-        else:
-            self.mode = SONG
-            self.placeholder = '搜索单曲'
+        self.switch_mode(1)
 
     def action_prev_mode(self) -> None:
-        if self.mode == SONG:
-            self.mode = PLAYLIST
-            self.placeholder = '搜索歌单'
-        elif self.mode == ALBUM:
-            self.mode = SONG
-            self.placeholder = '搜索单曲'
-        elif self.mode == ARTIST:
-            self.mode = ALBUM
-            self.placeholder = '搜索专辑'
-        else:
-            self.mode = ARTIST
-            self.placeholder = '搜索创作者'
+        self.switch_mode(-1)
 
-    def action_submit(self) -> None:
-        super().action_submit()
+    def switch_mode(self, step: int) -> None:
+        modes = list(MODES)
+        self.mode = modes[(modes.index(self.mode) + step) % len(modes)]
+        self.placeholder = MODES[self.mode]
+
+    def on_input_changed(self, event: Input.Changed) -> None:
+        # Local searches need no network round trip, they follow every keystroke.
+        # Offline, songs are searched among every track seen
+        if self.mode in (LIBRARY, FILTER) or self.mode == SONG and not network.online:
+            self.post_message(self.Filter(event.value, library=self.mode != FILTER))
+        elif event.value:
+            self.find(event.value, self.mode, DEBOUNCE)
+        elif self.pending:
+            self.pending.cancel()
+
+    async def action_submit(self) -> None:
+        await super().action_submit()
+        if self.mode in (LIBRARY, FILTER) or self.mode == SONG and not network.online:
+            self.post_message(self.Filter(self.value, library=self.mode != FILTER, focus=True))
+            return
         if not self.value:
             return
-        payload = GetSearchResult(self.value, stype=self.mode, limit=50)
-        if self.mode == SONG:
-            results = self.search_song(payload)
-        elif self.mode == ALBUM:
-            results = self.search_album(payload)
-        elif self.mode == ARTIST:
-            results = self.search_artist(payload)
-        else:
-            results = self.search_playlists(payload)
+        self.find(self.value, self.mode, focus=True)
 
-        message = self.UpdateTable(mode=self.mode, results=results)
-        self.post_message(message)
+    def find(self, query: str, mode: int, delay: float = 0, focus: bool = False) -> None:
+        """Search after delay seconds, unless the query changes in the meantime
+
+        A new search cancels the pending one, whose result is then discarded.
+        """
+        async def _find():
+            await asyncio.sleep(delay)
+            pages = self.pages(query, mode)
+            results = await call(next, pages, [])
+            message = self.UpdateTable(mode=mode, results=results, pages=pages, focus=focus)
+            self.post_message(message)
+        self.pending = spawn(self, 'tables', _find())
+
+    @classmethod
+    def pages(cls, query: str, mode: int):
+        """Iterate over the result pages of a search until they run out"""
+        seen = set()
+        for page in count():
+            results = cls.search(query, mode, page)
+            # Results may shift between pages, a repeated one would clash
+            # with its row key
+            fresh = []
+            for result in results:
+                key = result if mode == SONG else result[KEYS[mode]]
+                if key not in seen:
+                    seen.add(key)
+                    fresh.append(result)
+            yield fresh
+            if len(results) < PAGE:
+                return
+
+    @classmethod
+    def search(cls, query: str, mode: int, page: int = 0) -> list:
+        # Copied, the table extends the list it is given
+        return list(cls.fetch(query, mode, page))
+
+    @classmethod
+    @lru_cache(maxsize=CACHE_SIZE)
+    def fetch(cls, query: str, mode: int, page: int) -> tuple:
+        payload = apis.cloudsearch.GetSearchResult(query, stype=mode, limit=PAGE, offset=page * PAGE)
+        if mode == SONG:
+            return tuple(cls.search_song(payload))
+        elif mode == ALBUM:
+            return tuple(cls.search_album(payload))
+        elif mode == ARTIST:
+            return tuple(cls.search_artist(payload))
+        else:
+            return tuple(cls.search_playlists(payload))
 
     class UpdateTable(Message):
-        """Tell the app to update the table with search results"""
+        """Tell the app to update the table with search results
 
-        def __init__(self, mode: int, results: list):
+        Further pages are pulled from pages as the table is scrolled down.
+        """
+
+        def __init__(self, mode: int, results: list, pages=None, focus: bool = False):
             super().__init__()
             self.mode = mode
             self.results = results
+            self.pages = pages
+            self.focus = focus
+
+    class Filter(Message):
+        """Tell the app to filter the track table with the local index"""
+
+        def __init__(self, query: str, library: bool, focus: bool = False):
+            super().__init__()
+            self.query = query
+            self.library = library
+            self.focus = focus
 
     @staticmethod
     def search_song(payload: dict):
         tracks = []
-        for tr in payload['result']['songs']:
+        for tr in payload.get('result', {}).get('songs', []):
             name = tr['name']
             track_id = tr['id']
             artists = {ar['id']: ar['name'] for ar in tr['ar']}
             album = tr['al']['name']
             album_id = tr['al']['id']
             tracks.append(Track(name, track_id, artists, album, album_id))
+        index.add(tracks)
         return tracks
 
     @staticmethod
     def search_album(payload: dict):
         albums = []
-        for al in payload['result']['albums']:
+        for al in payload.get('result', {}).get('albums', []):
             name = al['name']
             album_id = al['id']
             artist = al['artist']['name']
@@ -108,7 +185,7 @@ class Search(Input):
     @staticmethod
     def search_artist(payload: dict):
         artists = []
-        for ar in payload['result']['artists']:
+        for ar in payload.get('result', {}).get('artists', []):
             name = ar['name']
             artist_id = ar['id']
             artists.append({'name': name, 'id': artist_id})
@@ -117,7 +194,7 @@ class Search(Input):
     @staticmethod
     def search_playlists(payload: dict) -> list:
         playlists = []
-        for pl in payload['result']['playlists']:
+        for pl in payload.get('result', {}).get('playlists', []):
             name = pl['name']
             playlist_id = pl['id']
             curator = pl['creator']['nickname']
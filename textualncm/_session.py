@@ -0,0 +1,58 @@
+from __future__ import annotations
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from _downloader import MAX_WORKERS
+from _worker import WORKERS
+
+# Hosts of the API, every other host is a CDN serving audio or images
+API_HOSTS = ('music.163.com', 'interface.music.163.com', 'interface3.music.163.com')
+# The worker pool, the metadata refreshers and the batching timers
+API_POOL = WORKERS + 4
+# Download workers, a track may be fetched from one of several CDN hosts
+CDN_POOL = MAX_WORKERS
+CDN_HOSTS = 16
+
+
+def api_adapter() -> HTTPAdapter:
+    # Connect failures are retried for every method, while failed reads and
+    # error statuses are only retried for requests that are safe to send twice
+    retry = Retry(total=3, connect=3, read=1, status=2, backoff_factor=0.25,
+                  status_forcelist=(429, 502, 503, 504), raise_on_status=False)
+    return HTTPAdapter(pool_connections=len(API_HOSTS), pool_maxsize=API_POOL, max_retries=retry)
+
+
+def cdn_adapter() -> HTTPAdapter:
+    # The downloader retries failed transfers itself, resuming them
+    retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.5)
+    return HTTPAdapter(pool_connections=CDN_HOSTS, pool_maxsize=CDN_POOL, max_retries=retry)
+
+
+def tune(session) -> None:
+    """Mount pools sized for the app's concurrency on a requests session
+
+    API hosts and CDN hosts get separate pools, so downloads never hold the
+    connections API calls wait for, and both keep their connections alive
+    between requests.
+    """
+    if f'https://{API_HOSTS[0]}' in session.adapters:
+        return
+    api = api_adapter()
+    session.mount('http://', cdn_adapter())
+    session.mount('https://', session.adapters['http://'])
+    for host in API_HOSTS:
+        session.mount(f'http://{host}', api)
+        session.mount(f'https://{host}', api)
+
+
+def reuse(session) -> dict[str, tuple[int, int]]:
+    """Connections opened and requests sent by the API and CDN pools of a tuned session"""
+    counts = {}
+    for name, prefix in (('api', f'https://{API_HOSTS[0]}'), ('cdn', 'https://')):
+        pools = session.get_adapter(prefix).poolmanager.pools
+        opened = requests = 0
+        for key in pools.keys():
+            if (pool := pools.get(key)) is not None:
+                opened += pool.num_connections
+                requests += pool.num_requests
+        counts[name] = opened, requests
+    return counts
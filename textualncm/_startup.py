@@ -0,0 +1,20 @@
+from __future__ import annotations
+import time
+
+# Imported first by app.py, so that phases include the imports
+start = time.perf_counter()
+phases: list[tuple[str, float]] = []
+
+
+def mark(phase: str) -> None:
+    """Record the end of a startup phase"""
+    phases.append((phase, time.perf_counter()))
+
+
+def report() -> str:
+    lines = [f'{"phase":<16}{"took":>10}{"since start":>14}']
+    last = start
+    for phase, at in phases:
+        lines.append(f'{phase:<16}{(at - last) * 1000:>7.1f} ms{(at - start) * 1000:>11.1f} ms')
+        last = at
+    return '\n'.join(lines)
@@ -0,0 +1,45 @@
+from rich.table import Table
+from textual.widgets import Static
+from pyncm import GetCurrentSession
+from _trace import tracer, size
+from _session import reuse
+
+
+class Stats(Static):
+    """Counters of the traced calls and the downloader, refreshed every second while shown"""
+
+    def on_mount(self):
+        self.display = False
+        self.timer = self.set_interval(1, self.show_stats, pause=True)
+
+    def toggle(self) -> None:
+        self.display = not self.display
+        if self.display:
+            self.show_stats()
+            self.timer.resume()
+        else:
+            self.timer.pause()
+
+    def show_stats(self) -> None:
+        table = Table(expand=True, box=None)
+        table.add_column('name')
+        for column in ('calls', 'errors', 'mean', 'p95', 'max', 'bytes'):
+            table.add_column(column, justify='right')
+        for name, row in tracer.summary():
+            table.add_row(f'[dim]{row["kind"]}[/] {name}',
+                          str(row['calls']),
+                          f'[red]{row["errors"]}[/]' if row['errors'] else '0',
+                          f'{row["mean_ms"]:.0f} ms',
+                          f'{row["p95_ms"]:.0f} ms',
+                          f'{row["max_ms"]:.0f} ms',
+                          size(row['bytes']) if row['bytes'] else '')
+        pools = []
+        for name, (opened, requests) in reuse(GetCurrentSession()).items():
+            reused = 1 - opened / requests if requests else 0
+            pools.append(f'{name} {opened} connections for {requests} requests, {reused:.0%} reused')
+        downloads = self.app.downloader.stats()
+        pools.append(f'downloads {downloads["queued"]} queued, {downloads["running"]}/{downloads["limit"]} running '
+                     f'at {size(downloads["throughput"])}/s, {downloads["completed"]} done, '
+                     f'{downloads["failed"]} failed')
+        table.caption = ' · '.join(pools)
+        self.update(table)
@@ -0,0 +1,13 @@
+from __future__ import annotations
+from collections import Counter
+
+# Address of the streaming proxy
+HOST = '127.0.0.1'
+PORT = 5000
+
+# Number of responses per track currently streaming from upstream
+streaming: Counter[int] = Counter()
+
+
+def url(track_id: int) -> str:
+    return f'http://{HOST}:{PORT}/track/{track_id}'
@@ -1,19 +1,43 @@
+from __future__ import annotations
 import asyncio
-from pyncm import apis
+import textual
+from functools import lru_cache
+from _index import index
+from _likes import likes
 from _track import Track
 from _menu import AlbumMenu, ArtistMenu, PlaylistMenu
+from _worker import load, stream
+from _trace import traced
 from textual import events
 from textual.app import ComposeResult
 from textual.widgets import DataTable
-from textual.widgets.data_table import CellDoesNotExist
+from textual.widgets.data_table import CellDoesNotExist, Row, RowKey
 from textual.coordinate import Coordinate
 from textual.binding import Binding
 from textual.message import Message
 from textual.containers import Container
-from pathlib import Path
+from _library import library
+try:
+    from textual._two_way_dict import TwoWayDict
+except ImportError:
+    TwoWayDict = None
+
+
+@lru_cache(maxsize=None)
+def in_place() -> bool:
+    # DataTable has no public way to remove or reorder rows, sync_rows works on
+    # its internals as laid out in textual 0.15 and rebuilds the table otherwise
+    return TwoWayDict is not None and textual.__version__.startswith('0.15.')
 
 
 class TableMixin(DataTable):
+    # The list of rows being paged and the iterator of the following pages
+    pages: tuple[list, object] | None = None
+    paging: asyncio.Task | None = None
+    # Number of rows of each key. An item listed more than once has a row each,
+    # keyed by its key, then key#2, key#3...
+    shown: dict[str, int] = {}
+
     BINDINGS = [
         Binding("k", "cursor_up", "Cursor Up", show=False),
         Binding("j", "cursor_down", "Cursor Down", show=False),
@@ -29,22 +53,139 @@ class TableMixin(DataTable):
         super()._on_focus(event)
         self.show_cursor = True
 
+    @traced('table rows', 'render')
+    def sync_rows(self, rows) -> None:
+        """Bring the table in line with rows, an iterable of (key, cells) pairs
+
+        Rows are matched by key: only new rows are added, missing rows removed
+        and changed cells updated, so the cost of an update follows the size of
+        the change rather than the size of the table.
+        """
+        self.shown = {}
+        rows = {self.row_key(key): cells for key, cells in rows}
+        if not in_place():
+            row = self.cursor_row
+            self.clear()
+            for key, cells in rows.items():
+                self.add_row(*cells, key=key)
+            self.cursor_coordinate = Coordinate(max(0, min(row, len(rows) - 1)), self.cursor_column)
+            return
+
+        cursor_key = None
+        if self.is_valid_row_index(self.cursor_row):
+            cursor_key = self._row_locations.get_key(self.cursor_row)
+
+        for key in [key for key in self.rows if key.value not in rows]:
+            del self._data[key]
+            del self.rows[key]
+
+        columns = [column.key for column in self.ordered_columns]
+        added = 0
+        for key, cells in rows.items():
+            data = self._data.get(key)
+            if data is None:
+                added += 1
+                row_key = RowKey(key)
+                self._data[row_key] = dict(zip(columns, cells))
+                self.rows[row_key] = Row(row_key, 1)
+                self._new_rows.add(row_key)
+                continue
+            for column, cell in zip(columns, cells):
+                if data[column] != cell:
+                    data[column] = cell
+
+        keys = {key.value: key for key in self.rows}
+        self._row_locations = TwoWayDict({keys[key]: index for index, key in enumerate(rows)})
+        self._update_count += 1
+        self._require_update_dimensions = True
+
+        # Follow the row under the cursor, or start from the top when the
+        # table shows entirely new content
+        row = self.cursor_row if added < len(rows) else 0
+        if cursor_key is not None and cursor_key in self._row_locations:
+            row = self._row_locations.get(cursor_key)
+        row = max(0, min(row, len(rows) - 1))
+        self.cursor_coordinate = Coordinate(row, self.cursor_column)
+        self.refresh()
+        self.check_idle()
+
+    def row_key(self, key: str) -> str:
+        """The key of a new row for key, unique in the table"""
+        count = self.shown.get(key, 0) + 1
+        self.shown[key] = count
+        return key if count == 1 else f'{key}#{count}'
+
+    def row_keys(self, key: str) -> list[str]:
+        """The keys of the rows of key"""
+        return [key] + [f'{key}#{count}' for count in range(2, self.shown.get(key, 1) + 1)]
+
+    @property
+    def items(self) -> list:
+        # Abstract method: The objects shown, one per row
+        pass
+
+    def extend(self, items: list) -> None:
+        # Abstract method: Appends rows for items to the table
+        pass
+
+    def paginate(self, pages) -> None:
+        """Pull further pages from an iterator as the end of the table comes into view"""
+        self.pages = (self.items, pages) if pages is not None else None
+        self.load_more()
+
+    def watch_scroll_y(self, old_value: float, new_value: float) -> None:
+        super().watch_scroll_y(old_value, new_value)
+        self.load_more()
+
+    def load_more(self) -> None:
+        if self.pages is None or self.paging and not self.paging.done():
+            return
+        rows, pages = self.pages
+        # Pages belong to the rows they were given with, not to whatever the
+        # table shows since
+        if rows is not self.items:
+            return
+        # Keep a screen of rows ahead of the view
+        if self.scroll_y + 2 * self.size.height < self.row_count:
+            return
+
+        def extend(page: list):
+            if self.pages is None or self.pages[1] is not pages or rows is not self.items:
+                return
+            if page:
+                self.extend(page)
+                self.load_more()
+            else:
+                self.pages = None
+        self.paging = load(self, f'more-{self.id}', extend, next, pages, [])
+
+    def show_tracks(self, fetch, *args) -> None:
+        message = self.ShowTracks(fetch, *args)
+        self.post_message(message)
+
     class ShowTracks(Message):
-        def __init__(self, tracks: list[Track]):
-            self.tracks = tracks
+        """Show the tracks returned by fetch(*args) in the track table"""
+
+        def __init__(self, fetch, *args):
+            self.fetch = fetch
+            self.args = args
             super().__init__()
 
 
 class TrackTable(TableMixin, DataTable):
     tracks: list[Track] = []
-    likes: list[Track] = []
-    watchlist: set[Track] = set()
+    # The tracks shown before filtering, and the result of the last filter
+    unfiltered: list[Track] = []
+    filtered: list[Track] | None = None
 
     BINDINGS = [
         Binding("p", "play", "播放"),
         Binding("f", "like", "喜欢/取消喜欢"),
         Binding("d", "download", "下载/删除"),
-        Binding("s", "subset", "筛选")
+        Binding("s", "subset", "筛选"),
+        Binding("n", "play_next", "下一首播放"),
+        Binding("a", "enqueue", "加入播放列表"),
+        Binding("x", "dequeue", "移出播放列表")
     ]
 
     def on_mount(self):
@@ -53,44 +194,71 @@ class TrackTable(TableMixin, DataTable):
         self.add_column('艺人', width=30, key='artist')
         self.add_column('专辑', width=30, key='album')
         self.add_column('本地', width=30, key='local')
-        self.set_interval(1, self.update_progress)
+
+    @property
+    def items(self) -> list[Track]:
+        return self.tracks
 
     def update(self):
-        self.clear()
+        self.sync_rows((str(track.id), self.row(track)) for track in self.tracks)
 
-        for track in self.tracks:
-            row = []
+    def extend(self, tracks: list[Track]):
+        """Append tracks to the table without rebuilding it"""
+        self.tracks.extend(tracks)
+        for track in tracks:
+            self.add_row(*self.row(track), key=self.row_key(str(track.id)))
 
-            if track.liked:
-                row.append(":sparkling_heart:")
-            else:
-                row.append('')
-            row.extend([track.name, track.artists, track.album])
+    @staticmethod
+    def row(track: Track) -> list:
+        row = []
 
-            if track.local:
-                row.append(':white_heavy_check_mark:')
-            else:
-                row.append(track.progress)
-            self.add_row(*row, key=str(track.id))
-
-    def update_progress(self):
-        for track in tuple(self.watchlist):
-            if track.local:
-                self.watchlist.remove(track)
-            try:
-                self.update_cell(str(track.id), 'local', track.progress)
-            except CellDoesNotExist:
-                pass
+        if track.liked:
+            row.append(":sparkling_heart:")
+        else:
+            row.append('')
+        row.extend([track.name, track.artists, track.album])
+
+        if track.local:
+            row.append(':white_heavy_check_mark:')
+        else:
+            row.append(track.progress)
+        return row
+
+    def filter(self, query: str, library: bool = False):
+        """Show the tracks matching query, out of every track seen or the table
+
+        An empty query brings back the tracks shown before filtering.
+        """
+        if self.tracks is not self.filtered:
+            self.unfiltered = self.tracks
+        if not query:
+            self.tracks = self.unfiltered
+        elif library:
+            self.tracks = index.search(query)
+        else:
+            self.tracks = index.filter(query, self.unfiltered)
+        self.filtered = self.tracks
+        self.update()
+
+    def show_progress(self, track: Track):
+        """Apply a download progress event of a track
+
+        Rows out of view are skipped unless the transfer has ended, they pick
+        up the progress with the next event after being scrolled into view.
+        """
+        for key in self.row_keys(str(track.id)):
+            row = self._row_locations.get(key)
+            if row is None:
+                continue
+            if track.downloading and not self.scroll_y <= row < self.scroll_y + self.size.height:
+                continue
+            self.update_cell(key, 'local', track.progress)
 
     def unlocal(self, track: Track):
         """Called when the local file of a track is deleted"""
         try:
-            self.watchlist.remove(track)
-        except KeyError:
-            pass
-
-        try:
-            self.update_cell(str(track.id), 'local', '')
+            for key in self.row_keys(str(track.id)):
+                self.update_cell(key, 'local', '')
         except CellDoesNotExist:
             pass
 
@@ -107,42 +275,52 @@ class TrackTable(TableMixin, DataTable):
         message = self.Play(track, self.tracks)
         self.post_message(message)
 
-    class Liked(Message):
-        """Notify the app that a track has been liked/unliked"""
+    class Enqueue(Message):
+        """Tell the app to add a track to the play queue, up next or at its end"""
 
-        def __init__(self, track: Track):
+        def __init__(self, track: Track, up_next: bool):
             self.track = track
+            self.up_next = up_next
             super().__init__()
 
-    def like(self, track: Track):
-        loop = asyncio.get_event_loop()
-        track.liked = not track.liked
+    def action_play_next(self):
+        message = self.Enqueue(self.tracks[self.cursor_row], True)
+        self.post_message(message)
 
-        def _like():
-            apis.track.SetLikeTrack(track.id, like=True)
+    def action_enqueue(self):
+        message = self.Enqueue(self.tracks[self.cursor_row], False)
+        self.post_message(message)
 
-        def _unlike():
-            apis.track.SetLikeTrack(track.id, like=False)
+    class Dequeue(Message):
+        """Tell the app to remove a track from the play queue"""
 
-        if track in self.tracks:
-            if track.liked:
-                self.update_cell(str(track.id), 'liked', ":sparkling_heart:")
-            else:
-                self.update_cell(str(track.id), 'liked', '')
+        def __init__(self, track: Track):
+            self.track = track
+            super().__init__()
 
-        if track.liked:
-            self.likes.insert(0, track)
-            thread = _like
-        else:
-            self.likes.remove(track)
-            thread = _unlike
+    def action_dequeue(self):
+        message = self.Dequeue(self.tracks[self.cursor_row])
+        self.post_message(message)
 
-        if self.tracks is self.likes:
-            self.update()
+    class Liked(Message):
+        """Notify the app that a track has been liked/unliked"""
 
+        def __init__(self, track: Track):
+            self.track = track
+            super().__init__()
+
+    def like(self, track: Track):
+        likes.toggle(track.id)
+        self.show_liked(track)
         message = self.Liked(track)
         self.post_message(message)
-        loop.run_in_executor(None, thread)
+
+    def show_liked(self, track: Track):
+        try:
+            for key in self.row_keys(str(track.id)):
+                self.update_cell(key, 'liked', ':sparkling_heart:' if track.liked else '')
+        except CellDoesNotExist:
+            pass
 
     def action_like(self):
         track = self.tracks[self.cursor_row]
@@ -159,16 +337,14 @@ class TrackTable(TableMixin, DataTable):
         track = self.tracks[self.cursor_row]
 
         if track.local:
-            Path().joinpath('downloads', f'{track.id}.mp3').unlink()
+            library.file(track.id).unlink()
             track.local = False
             self.unlocal(track)
         else:
-            self.watchlist.add(track)
             message = self.Download(track)
             self.post_message(message)
 
-    def scroll_to_track(self, track: Track) -> None:
-        row = self.tracks.index(track)
+    def scroll_to_row(self, row: int) -> None:
         column = 0
         self.cursor_coordinate: Coordinate = Coordinate(row, column)
         self.focus()
@@ -186,16 +362,14 @@ class TrackTable(TableMixin, DataTable):
             artists = self.tracks[self.cursor_row].artist_ids
             if len(artists) == 1:
                 artist_id = list(artists.keys())[0]
-                self.tracks = ArtistMenu.get_tracks(artist_id)
+                self.show_tracks(ArtistMenu.get_tracks, artist_id)
             else:
                 artists = [{'name': v, 'id': k} for k, v in artists.items()]
                 message = self.ShowArtists(artists)
                 self.post_message(message)
-            self.update()
         elif col_key == 'album':
             track = self.tracks[self.cursor_row]
-            self.tracks = AlbumMenu.get_tracks(str(track.album_id))
-            self.update()
+            self.show_tracks(AlbumMenu.get_tracks, str(track.album_id))
         elif col_key == 'local':
             self.action_download()
 
@@ -234,10 +408,21 @@ class AlbumTable(TableMixin, DataTable):
         self.add_column('发行日期', width=30, key='release')
         self.add_column('曲目', key='count')
 
+    @property
+    def items(self) -> list:
+        return self.albums
+
     def update(self) -> None:
-        self.clear()
-        for album in self.albums:
-            self.add_row(album['name'], album['artist'], album['release'], album['number'])
+        self.sync_rows((str(album['album_id']), self.row(album)) for album in self.albums)
+
+    def extend(self, albums: list) -> None:
+        self.albums.extend(albums)
+        for album in albums:
+            self.add_row(*self.row(album), key=self.row_key(str(album['album_id'])))
+
+    @staticmethod
+    def row(album: dict) -> list:
+        return [album['name'], album['artist'], album['release'], album['number']]
 
     def action_select_cursor(self) -> None:
         super().action_select_cursor()
@@ -245,13 +430,9 @@ class AlbumTable(TableMixin, DataTable):
         col_key = cursor_keys.column_key
         album = self.albums[self.cursor_row]
         if col_key == 'album':
-            tracks = AlbumMenu.get_tracks(album['album_id'])
-            message = self.ShowTracks(tracks)
-            self.post_message(message)
+            self.show_tracks(AlbumMenu.get_tracks, album['album_id'])
         elif col_key == 'artist':
-            tracks = ArtistMenu.get_tracks(album['artist_id'])
-            message = self.ShowTracks(tracks)
-            self.post_message(message)
+            self.show_tracks(ArtistMenu.get_tracks, album['artist_id'])
 
 
 class ArtistTable(TableMixin, DataTable):
@@ -261,17 +442,22 @@ class ArtistTable(TableMixin, DataTable):
         self.display = False
         self.add_column('创作者', width=30, key='artist')
 
+    @property
+    def items(self) -> list:
+        return self.artists
+
     def update(self) -> None:
-        self.clear()
-        for artist in self.artists:
-            self.add_row(artist['name'])
+        self.sync_rows((str(artist['id']), [artist['name']]) for artist in self.artists)
+
+    def extend(self, artists: list) -> None:
+        self.artists.extend(artists)
+        for artist in artists:
+            self.add_row(artist['name'], key=self.row_key(str(artist['id'])))
 
     def action_select_cursor(self) -> None:
         super().action_select_cursor()
         artist_id = self.artists[self.cursor_row]['id']
-        tracks = ArtistMenu.get_tracks(artist_id)
-        message = self.ShowTracks(tracks)
-        self.post_message(message)
+        self.show_tracks(ArtistMenu.get_tracks, artist_id)
 
 
 class PlaylistTable(TableMixin, DataTable):
@@ -283,17 +469,26 @@ class PlaylistTable(TableMixin, DataTable):
         self.add_column('Curator', width=30, key='curator')
         self.add_column('曲目', key='count')
 
+    @property
+    def items(self) -> list:
+        return self.playlists
+
     def update(self) -> None:
-        self.clear()
-        for pl in self.playlists:
-            self.add_row(pl['name'], pl['curator'], pl['count'])
+        self.sync_rows((str(pl['playlist_id']), self.row(pl)) for pl in self.playlists)
+
+    def extend(self, playlists: list) -> None:
+        self.playlists.extend(playlists)
+        for pl in playlists:
+            self.add_row(*self.row(pl), key=self.row_key(str(pl['playlist_id'])))
+
+    @staticmethod
+    def row(pl: dict) -> list:
+        return [pl['name'], pl['curator'], pl['count']]
 
     def action_select_cursor(self) -> None:
         super().action_select_cursor()
         plist_id = self.playlists[self.cursor_row]['playlist_id']
-        tracks = PlaylistMenu.get_tracks(plist_id)
-        message = self.ShowTracks(tracks)
-        self.post_message(message)
+        self.show_tracks(PlaylistMenu.stream_tracks, plist_id)
 
 
 class Tables(Container):
@@ -315,12 +510,29 @@ class Tables(Container):
         else:
             self.query_one(PlaylistTable).display = True
 
-    def on_table_mixin_show_tracks(self, message: AlbumTable.ShowTracks):
-        self.switch(1)
+    def show_tracks(self, fetch, *args) -> None:
+        """Fetch tracks off the event loop and stream them into the track table"""
         table = self.query_one(TrackTable)
-        table.tracks = message.tracks
-        table.update()
-        table.focus()
+
+        shown = None
+
+        def show(tracks):
+            nonlocal shown
+            shown = tracks
+            self.switch(1)
+            table.tracks = tracks
+            table.update()
+            table.focus()
+
+        def extend(tracks):
+            # Pages belong to the list they started, not to whatever the
+            # table shows since
+            if table.tracks is shown:
+                table.extend(tracks)
+        stream(self, 'tables', show, extend, fetch, *args)
+
+    def on_table_mixin_show_tracks(self, message: AlbumTable.ShowTracks):
+        self.show_tracks(message.fetch, *message.args)
 
     def on_track_table_show_artists(self, message: TrackTable.ShowArtists):
         self.switch(100)
@@ -0,0 +1,163 @@
+from __future__ import annotations
+import os
+import multiprocessing
+from multiprocessing import forkserver
+from pyncm import apis
+from functools import partial
+from pathlib import Path
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Lock, Timer
+from _cache import metacache
+from _library import library
+from _menu import strip_tracks
+from _network import network
+from _trace import tracer
+import _id3
+
+# Seconds to wait for more tracks before fetching their details
+WINDOW = 1
+# Most ids sent in one GetTrackDetail call
+BATCH = 500
+WORKERS = 2
+
+
+def context():
+    """Start method of the tagging processes
+
+    Forking the app would copy it with the locks its threads hold at that
+    moment, so workers are forked from a server process that only imported
+    _id3. Without a fork server, as on Windows, workers are spawned.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(['_id3'])
+    # The server is a new interpreter, started from any directory. It is
+    # started here, so that only it gets the path to _id3
+    old = os.environ.get('PYTHONPATH')
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [str(Path(__file__).parent), old]))
+    try:
+        forkserver.ensure_running()
+    finally:
+        if old is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = old
+    return ctx
+
+
+class Tagger:
+    """Writes tags and cover art into downloaded files in a pool of processes
+
+    The details of tracks submitted within a short window, cover URLs
+    included, are fetched in one GetTrackDetail call. Files are then tagged by
+    worker processes, away from the download threads and the UI. Tagged
+    tracks are recorded in the library, so a backfill only submits the others.
+    Offline, tracks wait until the API can be reached.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending: set[int] = set()
+        self.running: set[int] = set()
+        self.timer: Timer | None = None
+        self.pool: ProcessPoolExecutor | None = None
+        self.futures: set[Future] = set()
+        self.stopped = False
+        network.subscribe(self.reconnected)
+
+    def submit(self, track_id: int) -> None:
+        if _id3.ID3 is None:
+            return
+        with self.lock:
+            if track_id not in self.running:
+                self.pending.add(track_id)
+                self.schedule(WINDOW)
+
+    def backfill(self) -> int:
+        """Submit every downloaded track that has no tags yet, returning how many"""
+        track_ids = library.untagged()
+        for track_id in track_ids:
+            self.submit(track_id)
+        return len(track_ids)
+
+    def shutdown(self) -> None:
+        # Files being tagged are finished, the others are left for the next backfill
+        with self.lock:
+            self.stopped = True
+            self.pending.clear()
+            if self.timer is not None:
+                self.timer.cancel()
+            futures = list(self.futures)
+        # Files not yet handed to a worker are cancelled, which calls done
+        for future in futures:
+            future.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+    def schedule(self, delay: float) -> None:
+        if self.timer is None and self.pending and network.online and not self.stopped:
+            self.timer = Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def reconnected(self, online: bool) -> None:
+        if online:
+            with self.lock:
+                self.schedule(WINDOW)
+
+    def flush(self) -> None:
+        with self.lock:
+            self.timer = None
+            batch = list(self.pending)[:BATCH]
+            self.pending.difference_update(batch)
+            self.running.update(batch)
+        try:
+            network.require()
+            songs = apis.track.GetTrackDetail(batch)['songs']
+        except Exception as exc:
+            songs = []
+            if network.check(exc):
+                # Sent again once back online
+                with self.lock:
+                    self.pending.update(batch)
+        # Downloaded tracks are listed offline from their stored metadata
+        metacache.put_many('track', {song['id']: song for song in strip_tracks(songs)})
+
+        songs = [song for song in songs if song['id'] in library]
+        with self.lock:
+            self.running.difference_update(batch)
+            if self.stopped:
+                return
+            self.running.update(song['id'] for song in songs)
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(WORKERS, mp_context=context())
+            # Submitted under the lock, so that a shutdown sees every future
+            futures = []
+            for song in songs:
+                path = str(library.file(song['id']))
+                future = self.pool.submit(_id3.write_tags, path, song)
+                self.futures.add(future)
+                futures.append((song['id'], future))
+            # Large backfills go on batch after batch
+            self.schedule(0)
+        for track_id, future in futures:
+            future.add_done_callback(partial(self.done, track_id))
+
+    def done(self, track_id: int, future: Future) -> None:
+        with self.lock:
+            self.running.discard(track_id)
+            self.futures.discard(future)
+        if future.cancelled():
+            return
+        try:
+            event = future.result()
+        except Exception as exc:  # noqa
+            # The worker process died
+            event = {'kind': 'tag', 'name': 'tag', 'bytes': 0, 'error': type(exc).__name__, 'ms': 0.0}
+        tracer.record(event)
+        if event['error'] is None and track_id in library:
+            library.tag(track_id)
+
+
+tagger = Tagger()
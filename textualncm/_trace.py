@@ -0,0 +1,137 @@
+from __future__ import annotations
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+
+# Latencies kept per name for the percentiles
+SAMPLES = 512
+# pyncm functions that are not requests
+SKIP = ('GetCurrentSession', 'SetCurrentSession')
+
+
+class Stat:
+    __slots__ = ('kind', 'calls', 'errors', 'bytes', 'total', 'latencies')
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total = 0.0
+        self.latencies: deque[float] = deque(maxlen=SAMPLES)
+
+    def row(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {'kind': self.kind,
+                'calls': self.calls,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'total_ms': self.total,
+                'mean_ms': self.total / self.calls,
+                'p95_ms': latencies[int(len(latencies) * 0.95)],
+                'max_ms': latencies[-1]}
+
+
+class Tracer:
+    """Latency, byte and error counters of API calls, proxy requests and downloads
+
+    Every traced operation is counted under its name. With a file open, each
+    one is also appended to it as a line of JSON.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stats: dict[str, Stat] = {}
+        self.file = None
+        # API call running on each thread, its responses add to its bytes
+        self.local = local()
+
+    def open(self, path) -> None:
+        self.file = open(path, 'a', buffering=1, encoding='utf-8')
+
+    @contextmanager
+    def span(self, name: str, kind: str):
+        """Trace the enclosed operation, which may set bytes and other fields of the event"""
+        event = {'kind': kind, 'name': name, 'bytes': 0, 'error': None}
+        if kind == 'api':
+            self.local.event = event
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException as exc:
+            event['error'] = type(exc).__name__
+            raise
+        finally:
+            if kind == 'api':
+                self.local.event = None
+            event['ms'] = (time.perf_counter() - start) * 1000
+            self.record(event)
+
+    def record(self, event: dict) -> None:
+        with self.lock:
+            stat = self.stats.get(event['name'])
+            if stat is None:
+                stat = self.stats[event['name']] = Stat(event['kind'])
+            stat.calls += 1
+            stat.errors += event['error'] is not None
+            stat.bytes += event['bytes']
+            stat.total += event['ms']
+            stat.latencies.append(event['ms'])
+            if self.file:
+                self.file.write(json.dumps({'time': time.time(), **event}, ensure_ascii=False) + '\n')
+
+    def summary(self) -> list[tuple[str, dict]]:
+        """Counters of every name, those that took the longest in total first"""
+        with self.lock:
+            rows = [(name, stat.row()) for name, stat in self.stats.items()]
+        return sorted(rows, key=lambda row: -row[1]['total_ms'])
+
+    def count_bytes(self, response, *_, **__):
+        # requests response hook, downloads stream their body and count it themselves
+        event = getattr(self.local, 'event', None)
+        if event is not None:
+            event['bytes'] += len(response.content)
+
+
+tracer = Tracer()
+
+
+def traced(name: str, kind: str = 'api'):
+    """Decorate a function to trace its calls, a pyncm payload with a code other than 200 is an error"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name, kind) as event:
+                result = fn(*args, **kwargs)
+                if isinstance(result, dict) and result.get('code', 200) != 200:
+                    event['error'] = f'code {result["code"]}'
+                return result
+        wrapper.traced = True
+        return wrapper
+    return decorator
+
+
+def instrument(apis, session) -> None:
+    """Trace every request function of pyncm.apis and count the bytes of session responses
+
+    Callers must look functions up on their module when calling them, not
+    import them by name, for the traced ones to be used.
+    """
+    for module in (apis.user, apis.album, apis.playlist, apis.track, apis.cloudsearch):
+        for name, fn in list(vars(module).items()):
+            if name.startswith(('Get', 'Set')) and name not in SKIP and callable(fn) \
+                    and not getattr(fn, 'traced', False):
+                setattr(module, name, traced(name)(fn))
+    if tracer.count_bytes not in session.hooks['response']:
+        session.hooks['response'].append(tracer.count_bytes)
+
+
+def size(n: float) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if n < 1024:
+            return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1024
+    return f'{n:.1f} GiB'
@@ -1,66 +1,72 @@
-import sys
+from __future__ import annotations
 from weakref import WeakValueDictionary
-from pathlib import Path
 from rich.progress import Progress, BarColumn
-
-
-if getattr(sys, "frozen", False):
-    datadir = Path(sys.executable).parent
-else:
-    datadir = Path(__file__).parent
-downloads = datadir.joinpath('downloads')
-if not downloads.exists():
-    downloads.mkdir()
+from _library import library
+from _likes import likes
 
 
 class Track:
-    _initialized = False
+    __slots__ = ('name', 'id', 'artist_ids', 'album', 'album_id', 'downloading', 'length', 'size', 'xfered', '_progress', '__weakref__')
     _registry = WeakValueDictionary()
 
-    # The '_locals' variable does not need to be updated during runtime
-    # It only stores the ids of local tracks at start time
-    _locals = [int(path.stem) for path in downloads.iterdir()]
-
-    def __init__(self, name, _id, artists, album, album_id):
-        # Prevent initialization on created instance
-        if self._initialized:
-            return
-
-        self.name: str = name
-        self.id: int = _id
-        self.artist_ids: dict[int, str] = artists
-        self.album: str = album
-        self.album_id: int = album_id
-        self.local: bool = _id in self._locals
-        self.liked: bool = False
-        self.downloading: bool = False
-        self.length: int = 0
-        self.size: int = 0
-        self.xfered: int = 0
-        self._progress: Progress = Progress(BarColumn(), auto_refresh=False)
-        self.task = self._progress.add_task('', total=None)
-        self._initialized = True
-
     def __new__(cls, name, _id, artists, album, album_id):
-        if _id in cls._registry:
-            return cls._registry[_id]
+        # Tracks are unique per id, an existing instance is returned as is
+        if (instance := cls._registry.get(_id)) is not None:
+            return instance
         instance = super().__new__(cls)
+        instance.name: str = name
+        instance.id: int = _id
+        instance.artist_ids: dict[int, str] = artists
+        instance.album: str = album
+        instance.album_id: int = album_id
+        instance.downloading: bool = False
+        instance.length: int = 0
+        instance.size: int = 0
+        instance.xfered: int = 0
+        # Only created once the track is downloading
+        instance._progress: Progress | None = None
         cls._registry[_id] = instance
         return instance
 
     def __hash__(self):
         return self.id
 
+    @property
+    def local(self) -> bool:
+        return self.id in library
+
+    @local.setter
+    def local(self, local: bool):
+        if not local:
+            library.remove(self.id)
+        elif self.id not in library:
+            library.add(self.id)
+
+    @property
+    def liked(self) -> bool:
+        return self.id in likes
+
     @property
     def progress(self):
         if self.local:
+            self._progress = None
             return ':white_heavy_check_mark:'
         if self.downloading:
+            if self._progress is None:
+                self._progress = Progress(BarColumn(), auto_refresh=False)
+                self._progress.add_task('', total=None)
             with self._progress as p:
-                p.update(self.task, total=self.size, completed=self.xfered)
+                p.update(p.task_ids[0], total=self.size or None, completed=self.xfered)
                 return p
         return ''
 
+    def payload(self) -> dict:
+        """The track as the stripped API payload it was parsed from"""
+        return {'name': self.name,
+                'id': self.id,
+                'ar': [{'id': k, 'name': v} for k, v in self.artist_ids.items()],
+                'al': {'id': self.album_id, 'name': self.album}}
+
     @property
     def artists(self):
         return ', '.join(self.artist_ids.values())
@@ -0,0 +1,91 @@
+from __future__ import annotations
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from textual.widget import Widget
+from _network import network
+
+
+WORKERS = 8
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='ncm')
+_tasks: dict[str, tuple[asyncio.Task, Widget]] = {}
+
+
+async def call(fn, *args, **kwargs):
+    """Run a blocking function on the worker pool and await its result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(fn, *args, **kwargs))
+
+
+def load(owner: Widget, key: str, callback, fn, *args) -> asyncio.Task:
+    """Call fn(*args) on the worker pool and pass its result to callback
+
+    Only the latest load of each key survives: starting a new one cancels the
+    pending one, whose result is then discarded. The owner widget carries the
+    'loading' class until its load completes.
+    """
+    async def _load():
+        result = await call(fn, *args)
+        callback(result)
+    return spawn(owner, key, _load())
+
+
+def stream(owner: Widget, key: str, show, extend, fn, *args) -> asyncio.Task:
+    """Like load, for functions returning either a list or an iterator of lists
+
+    The first page is passed to show and every following page to extend, each
+    as soon as it is available.
+    """
+    async def _stream():
+        pages = await call(fn, *args)
+        if isinstance(pages, list):
+            show(pages)
+            return
+        step = None
+        try:
+            callback = show
+            while True:
+                step = executor.submit(next, pages, None)
+                if (page := await asyncio.wrap_future(step)) is None:
+                    break
+                callback(page)
+                callback = extend
+        finally:
+            # A generator can't be closed while it runs on another thread,
+            # it is closed once the page it is fetching is done
+            if step is None or step.done():
+                executor.submit(pages.close)
+            else:
+                step.add_done_callback(lambda _: pages.close())
+    return spawn(owner, key, _stream())
+
+
+def spawn(owner: Widget, key: str, coro) -> asyncio.Task:
+    cancel(key)
+    task = asyncio.create_task(coro)
+    _tasks[key] = task, owner
+    owner.add_class('loading')
+
+    def done(_):
+        if _tasks.get(key, (None,))[0] is task:
+            del _tasks[key]
+        if all(other is not owner for _, other in _tasks.values()):
+            owner.remove_class('loading')
+        if not task.cancelled() and task.exception():
+            owner.log.error(f'{key}: {task.exception()!r}')
+            # Offline, requests are expected to fail
+            if not network.check(task.exception()):
+                owner.app.bell()
+
+    task.add_done_callback(done)
+    return task
+
+
+def pending() -> list[asyncio.Task]:
+    return [task for task, _ in _tasks.values()]
+
+
+def cancel(key: str) -> None:
+    if key in _tasks:
+        task, _ = _tasks[key]
+        task.cancel()
@@ -1,11 +1,23 @@
+from __future__ import annotations
 import sys
+from _startup import mark, report
+import asyncio
 from _login import login
 from _menu import MenuTree
 from _table import *
-from _downloader import Downloader
+from _downloader import Downloader, PLAYING
+from _tagger import tagger
 from _player import Player
-from _proxy import app as proxy
 from _search import Search
+from _library import library
+from _likes import likes
+from _worker import pending
+from _network import network
+from _cache import metacache
+from _trace import tracer, instrument
+from _session import tune
+from _stats import Stats
+from pyncm import apis, GetCurrentSession
 from textual.app import App, ComposeResult
 from textual.binding import Binding
 from textual.widgets import Header, Footer
@@ -32,9 +44,66 @@ class NeteaseCloudMusic(App):
         Binding('left_square_bracket', 'prev', 'Prev', show=False),
         Binding('right_square_bracket', 'next', 'Next', show=False),
         Binding('ctrl+f', 'like', 'Like/Unlike', show=False),
-        Binding('ctrl+d', 'download', 'Download/Delete', show=False)
+        Binding('ctrl+d', 'download', 'Download/Delete', show=False),
+        Binding('ctrl+t', 'stats', 'Stats', show=False)
     ]
-    downloader = Downloader()
+    profile = False
+
+    def __init__(self):
+        super().__init__()
+        # Bindings may run before the first frame, its threads start after it
+        self.downloader = Downloader()
+
+    def on_mount(self):
+        mark('mount')
+        self.call_after_refresh(self.start)
+
+    def start(self):
+        """Start everything the first frame does not need"""
+        mark('first frame')
+        tune(GetCurrentSession())
+        instrument(apis, GetCurrentSession())
+        server = Thread(target=serve, daemon=True)
+        server.start()
+        self.downloader.start()
+        self.set_interval(5, self.refresh_library)
+        loop = asyncio.get_running_loop()
+        table: TrackTable = self.query_one(TrackTable)
+        # Progress events come from download threads
+        self.downloader.subscribe(lambda track: loop.call_soon_threadsafe(table.show_progress, track))
+        likes.subscribe(lambda track_ids: loop.call_soon_threadsafe(self.show_reverted, track_ids))
+        # Payloads are refreshed on background threads
+        metacache.subscribe(lambda old, new: loop.call_soon_threadsafe(self.show_refreshed, old, new))
+        network.subscribe(lambda online: loop.call_soon_threadsafe(self.set_online, online))
+        network.start()
+        # Tag the files downloaded before tagging or while it failed
+        tagger.backfill()
+        mark('downloader')
+        self.query_one(MenuTree).load_menus()
+        mark('menu requests')
+        _ = self.query_one(Player).player
+        mark('vlc')
+        if self.profile:
+            asyncio.create_task(self.finish_profile())
+
+    async def finish_profile(self):
+        # Quit once the initial loads are done, the timings are printed on exit
+        await asyncio.gather(*pending(), return_exceptions=True)
+        mark('initial loads')
+        self.action_quit()
+
+    def set_online(self, online: bool):
+        # Offline the app keeps running from cached metadata and local files
+        self.sub_title = '' if online else '离线'
+        if online:
+            self.query_one(MenuTree).reconnect()
+
+    def refresh_library(self):
+        # Pick up files added or removed outside the app
+        if library.refresh():
+            tagger.backfill()
+            self.query_one(TrackTable).update()
+            self.query_one(Player).show_track()
 
     def compose(self) -> ComposeResult:
         yield Header()
@@ -42,6 +111,7 @@ class NeteaseCloudMusic(App):
         yield Search(id='searchbar', placeholder='搜索歌曲')
         yield Tables(id='tables')
         yield Player(id='player')
+        yield Stats(id='stats')
         yield Footer()
 
     def action_like(self):
@@ -59,15 +129,18 @@ class NeteaseCloudMusic(App):
 
         # If track is already local, delete its file
         if track.local:
-            Path().joinpath('downloads', f'{track.id}.mp3').unlink()
+            library.file(track.id).unlink()
             track.local = False
             table.unlocal(track)
         else:
-            table.watchlist.add(track)
-            self.downloader.submit(track)
+            self.downloader.submit(track, PLAYING)
+
+    def action_stats(self):
+        self.query_one(Stats).toggle()
 
     def action_quit(self):
         self.downloader.shutdown()
+        tagger.shutdown()
         self.exit()
 
     def action_pause(self):
@@ -81,10 +154,12 @@ class NeteaseCloudMusic(App):
     def action_current(self):
         player: Player = self.query_one(Player)
         table: TrackTable = self.query_one(TrackTable)
-        if player.playlist:
-            table.tracks = player.playlist
+        if player.queue:
+            table.tracks = player.queue.listing()
             table.update()
-            table.scroll_to_track(player.track)
+            # The current track may have been removed from the queue
+            if (row := player.queue.index(player.track)) is not None:
+                table.scroll_to_row(row)
 
     def action_prev(self):
         player: Player = self.query_one(Player)
@@ -95,14 +170,28 @@ class NeteaseCloudMusic(App):
         player.next()
 
     def on_menu_tree_update_table(self, message: MenuTree.UpdateTable):
+        tables = self.query_one(Tables)
+        tables.show_tracks(message.fetch, *message.args)
+
+    def on_menu_tree_likes(self, _: MenuTree.Likes):
+        self.query_one(TrackTable).update()
+        self.query_one(Player).show_track()
+
+    def show_refreshed(self, old, new):
+        # A table showing a list that was refetched shows the new one
         table: TrackTable = self.query_one(TrackTable)
-        table.tracks = message.tracks
-        table.update()
-        table.focus()
+        if table.tracks is old:
+            table.tracks = new
+            table.update()
 
-    def on_menu_tree_likes(self, message: MenuTree.Likes):
+    def show_reverted(self, track_ids: set[int]):
+        # Likes the server kept refusing are shown as they are there
         table: TrackTable = self.query_one(TrackTable)
-        table.likes = message.tracks
+        for track in table.tracks:
+            if track.id in track_ids:
+                table.show_liked(track)
+        self.query_one(Player).show_track()
+        self.bell()
 
     def on_menu_tree_play(self, message: MenuTree.Play):
         player: Player = self.query_one(Player)
@@ -110,26 +199,47 @@ class NeteaseCloudMusic(App):
             player.play_playlist(message.tracks)
 
     def on_menu_tree_download(self, message: MenuTree.Download):
-        table: TrackTable = self.query_one(TrackTable)
-        for track in message.tracks:
-            if not track.local:
-                table.watchlist.add(track)
-                self.downloader.submit(track)
+        tracks = [track for track in message.tracks if not track.local]
+        self.downloader.submit_many(tracks)
 
     def on_track_table_play(self, message: TrackTable.Play):
         player: Player = self.query_one(Player)
-        player.play(message.track)
-        player.set_playlist(message.tracks)
+        player.play_from(message.tracks, message.track)
+
+    def on_track_table_enqueue(self, message: TrackTable.Enqueue):
+        player: Player = self.query_one(Player)
+        if message.up_next:
+            player.play_next(message.track)
+        else:
+            player.enqueue(message.track)
+
+    def on_track_table_dequeue(self, message: TrackTable.Dequeue):
+        player: Player = self.query_one(Player)
+        table: TrackTable = self.query_one(TrackTable)
+        # The table may be showing the queue, which is listed anew once changed
+        showing = table.tracks is player.queue.listed
+        player.dequeue(message.track)
+        if showing:
+            table.tracks = player.queue.listing()
+            table.update()
 
     def on_track_table_liked(self, message: TrackTable.Liked):
         player: Player = self.query_one(Player)
         if player.track is message.track:
-            player.refresh()
+            player.show_track()
 
     def on_track_table_download(self, message: TrackTable.Download):
         track = message.track
         self.downloader.submit(track)
 
+    def on_search_filter(self, message: Search.Filter):
+        tables = self.query_one(Tables)
+        tables.switch(1)
+        table = self.query_one(TrackTable)
+        table.filter(message.query, message.library)
+        if message.focus:
+            table.focus()
+
     def on_search_update_table(self, message: Search.UpdateTable):
         tables = self.query_one(Tables)
         tables.switch(message.mode)
@@ -148,13 +258,29 @@ class NeteaseCloudMusic(App):
             table.playlists = message.results
 
         table.update()
-        table.focus()
+        table.paginate(message.pages)
+        if message.focus:
+            table.focus()
 
 
-if __name__ == '__main__':
+def serve():
+    # aiohttp is imported here, on the server thread after the first frame
+    import _proxy
+    _proxy.run()
+
+
+def main():
+    mark('imports')
     login()
-    server = Thread(target=proxy.run)
-    server.daemon = True
-    server.start()
+    mark('login')
     app = NeteaseCloudMusic()
+    app.profile = '--profile-startup' in sys.argv
+    if '--trace' in sys.argv:
+        tracer.open(sys.argv[sys.argv.index('--trace') + 1])
     app.run()
+    if app.profile:
+        print(report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+import multiprocessing
+
+if __name__ == '__main__':
+    # Tagging runs in worker processes, which a frozen executable must let
+    # start. They import this module as their main one, so the app is only
+    # imported here
+    multiprocessing.freeze_support()
+    from app import main
+    main()